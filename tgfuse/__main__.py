@@ -14,7 +14,13 @@ async def main():
     await start_bot()
 
 if __name__ == '__main__':
-    if Config.tg_id and Config.tg_hash:
+    if sys.argv[1:2] == ['replay']:
+        from tgfuse.core.replay import main as replay_main
+        replay_main(sys.argv[2:])
+    elif sys.argv[1:2] == ['bench']:
+        from tgfuse.core.bench import main as bench_main
+        bench_main(sys.argv[2:])
+    elif Config.tg_id and Config.tg_hash:
         try:
             asyncio.run(main())
         except KeyboardInterrupt:
@@ -8,6 +8,23 @@ class Config:
     ftp: bool = False
     cache: bool = False
     chat_id: int = 0
+    chat_ids: str = ''
+    spread: bool = False
+    # Not /tmp: often a tmpfs, i.e. RAM, and cleared on reboot
+    cache_dir: str = os.path.join(
+        os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'tgfuse'
+    )
+    cache_limit: int = 2048
+    mem_limit: int = 512
+    upload_queue: int = 8
+    head_cache: int = 64
+    head_prefetch: int = 0
+    workers: int = 4
+    file_rate: int = 100
+    trace: str = ''
+
+    # Paths, `~` is expanded as in a shell
+    _paths = ('cache_dir', 'trace')
 
     @classmethod
     def load_from_env(cls):
@@ -19,6 +36,8 @@ class Config:
                     setattr(cls, key, env_value.lower() in ('true', '1', 'yes'))
                 elif isinstance(current_value, int):
                     setattr(cls, key, int(env_value))
+                elif key in cls._paths:
+                    setattr(cls, key, os.path.expanduser(env_value))
                 else:
                     setattr(cls, key, env_value)
 
@@ -1,7 +1,5 @@
 import logging, os
 from tgfuse.config.config import Config
-from pyftpdlib.log import config_logging
-config_logging(level=logging.ERROR, prefix='%(levelname)s: %(module)s: %(message)s')
 
 RESET = "\x1b[0m"
 WHITE = "\x1b[0m"
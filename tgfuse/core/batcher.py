@@ -0,0 +1,111 @@
+import asyncio, contextlib
+
+from pyrogram.errors import Forbidden
+
+from tgfuse.core.ratelimit import limiter
+from tgfuse.config import logging_config
+log = logging_config.setup_logging(__name__)
+
+# delete_messages() accepts up to 100 ids per call
+MAX_BATCH = 100
+
+
+class DeleteBatcher:
+    """
+    Collects message ids to delete and removes them with as few
+    delete_messages() calls as possible: a batch goes out `delay` seconds
+    after its first id, or as soon as it is full.
+    Ids stay in `pending` until a sync no longer sees them in the channel, so
+    it doesn't bring them back meanwhile; failures are sorted out in reconcile().
+    """
+    def __init__(self, client, chat_id: int, delay: float = 0.5):
+        self._tg_client = client
+        self._chat_id = chat_id
+        self._delay = delay
+        # waiting for the next flush
+        self._queue = []
+        # deleted locally, still seen in the channel by the last sync
+        self.pending = set()
+        # failed, worth another try
+        self._failed = set()
+        # failed for lack of rights
+        self._forbidden = set()
+        self._flush_task = None
+        # batches being sent: full ones and the timer's
+        self._tasks = set()
+
+    def add(self, msg_id: int):
+        self.pending.add(msg_id)
+        self._queue.append(msg_id)
+        if len(self._queue) >= MAX_BATCH:
+            self._track(asyncio.create_task(self.flush()))
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def _track(self, task: asyncio.Task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._delay)
+        # Sending now => close() must wait for it rather than cancel it
+        self._track(asyncio.current_task())
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        while self._queue:
+            batch = self._queue[:MAX_BATCH]
+            del self._queue[:MAX_BATCH]
+            try:
+                await limiter.call(
+                    'delete', self._tg_client.delete_messages, self._chat_id, batch,
+                    scope=self._chat_id
+                )
+            except Forbidden as e:
+                log.warning(f"Not allowed to delete {len(batch)} messages: {e}")
+                self._forbidden.update(batch)
+                continue
+            except Exception as e:
+                # RPC errors as well as dropped connections and timeouts
+                log.warning(f"Deleting {len(batch)} messages failed, retry on next sync: {e}")
+                self._failed.update(batch)
+                continue
+            except asyncio.CancelledError:
+                # Still hidden via `pending` => must not get lost
+                self._failed.update(batch)
+                raise
+            log.debug(f"Deleted {len(batch)} messages in one call.")
+
+    def reconcile(self, present: set):
+        """
+        Called by the sync with the message ids currently in the channel.
+        Ids that are gone are done, forbidden ones are given up (their files
+        come back with this sync), the other failures are queued again.
+        """
+        self.pending.intersection_update(present)
+        self._forbidden.intersection_update(present)
+        self.pending.difference_update(self._forbidden)
+        if self._forbidden:
+            log.info(f"{len(self._forbidden)} files couldn't be deleted => restored.")
+        self._forbidden.clear()
+
+        retry = self._failed & present
+        self._failed.clear()
+        for msg_id in retry:
+            self.add(msg_id)
+
+    async def close(self):
+        """Send out what is still queued, e.g. on unmount."""
+        if self._flush_task:
+            self._flush_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flush_task
+            self._flush_task = None
+        # Batches already on their way
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+        await self.flush()
+
+if __name__ == "__main__":
+    raise RuntimeError("This module should be run only via main.py")
@@ -0,0 +1,144 @@
+import os, time, shutil, asyncio, argparse, tempfile
+
+from tgfuse.core.fuse import TelegramFS
+from tgfuse.core.offload import LoopMonitor
+from tgfuse.core.replay import FakeClient
+from tgfuse.funcs.index import save_index
+from tgfuse.config.config import Config
+from tgfuse.config import logging_config
+log = logging_config.setup_logging(__name__)
+
+CHAT_ID = -100
+# Size of the writes the kernel sends with big_writes
+WRITE_SIZE = 128 * 1024
+
+
+def _ms(lags: list) -> str:
+    lags = sorted(lags)
+    if not lags:
+        return "no samples"
+    p50 = lags[len(lags) // 2]
+    p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))]
+    return (
+        f"p50 {p50 * 1000:.2f}ms, p99 {p99 * 1000:.2f}ms, "
+        f"max {lags[-1] * 1000:.1f}ms over {len(lags)} samples"
+    )
+
+
+class Bench:
+    """
+    Downloads and writes big files through TelegramFS while timing small
+    metadata ops (lookup + getattr) every few ms, the way `ls` or a file
+    manager would during a copy. Their latency is the time the event loop
+    is blocked by the transfers.
+    """
+    def __init__(self, fs: TelegramFS, files: int, size: int, writers: int):
+        self._fs = fs
+        self._files = files
+        self._size = size
+        self._writers = writers
+        self.lags = []
+
+    async def _probe(self, stop: asyncio.Event, interval: float = 0.002):
+        while not stop.is_set():
+            # From when the request would arrive to its answer
+            started = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            await self._fs.lookup(1, b'f0.bin', None)
+            await self._fs.getattr(1, None)
+            self.lags.append(time.perf_counter() - started)
+
+    async def _download(self, name: bytes):
+        attr = await self._fs.lookup(1, name, None)
+        fi = await self._fs.open(attr.st_ino, os.O_RDWR, None)
+        await self._fs.read(fi.fh, 0, WRITE_SIZE)
+        await self._fs.release(fi.fh)
+
+    async def _write(self, name: bytes):
+        fi, _ = await self._fs.create(1, name, 0o644, 0, None)
+        chunk = os.urandom(WRITE_SIZE)
+        for offset in range(0, self._size, WRITE_SIZE):
+            await self._fs.write(fi.fh, offset, chunk)
+        await self._fs.release(fi.fh)
+
+    async def idle(self, seconds: float) -> list:
+        stop = asyncio.Event()
+        probe = asyncio.create_task(self._probe(stop))
+        await asyncio.sleep(seconds)
+        stop.set()
+        await probe
+        lags, self.lags = self.lags, []
+        return lags
+
+    async def transfers(self) -> tuple:
+        stop = asyncio.Event()
+        probe = asyncio.create_task(self._probe(stop))
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(self._download(f"f{i}.bin".encode()) for i in range(self._files)),
+            *(self._write(f"w{i}.bin".encode()) for i in range(self._writers)),
+        )
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await probe
+        lags, self.lags = self.lags, []
+        return lags, elapsed
+
+
+async def _bench(args) -> tuple:
+    docs = {CHAT_ID: {
+        i + 1: (f"f{i}.bin", args.size * 1024 * 1024, 'application/octet-stream')
+        for i in range(args.files)
+    }}
+    client = FakeClient(docs, {})
+    fs = TelegramFS(client, [(CHAT_ID, 'Bench', False)], cache_enabled=Config.cache)
+    await fs.init_fs()
+    monitor = LoopMonitor(interval=0.01)
+    monitor.start()
+    bench = Bench(fs, args.files, args.size * 1024 * 1024, args.writers)
+    idle = await bench.idle(0.5)
+    busy, elapsed = await bench.transfers()
+    await monitor.stop()
+    await fs.destroy()
+    return idle, busy, elapsed, monitor.report()
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(
+        prog='tgfuse bench',
+        description="Measure the latency of metadata ops while big files are transferred."
+    )
+    parser.add_argument('--files', type=int, default=4, help="files downloaded at once (default: 4)")
+    parser.add_argument('--writers', type=int, default=2, help="files written at once (default: 2)")
+    parser.add_argument('--size', type=int, default=96, help="size of each file in MiB (default: 96)")
+    parser.add_argument(
+        '--mem-limit', type=int, default=64,
+        help="MEM_LIMIT in MiB, below the transferred size so buffers spill (default: 64)"
+    )
+    parser.add_argument('--no-cache', action='store_true', help="run with CACHE off")
+    args = parser.parse_args(argv)
+
+    Config.cache_dir = tempfile.mkdtemp(prefix='tgfuse-bench-')
+    Config.mem_limit = args.mem_limit
+    Config.cache = not args.no_cache
+    # Files listed from the cached index => no listing delay
+    save_index(Config.cache_dir, CHAT_ID, [
+        (i + 1, f"{CHAT_ID}:{i + 1}", f"f{i}.bin".encode(), args.size * 1024 * 1024, 0,
+         'application/octet-stream')
+        for i in range(args.files)
+    ])
+    log.info(
+        f"Bench: {args.files} downloads and {args.writers} writes of {args.size} MiB, "
+        f"MEM_LIMIT {args.mem_limit} MiB, WORKERS {Config.workers}."
+    )
+    try:
+        idle, busy, elapsed, lag = asyncio.run(_bench(args))
+    finally:
+        shutil.rmtree(Config.cache_dir, ignore_errors=True)
+
+    print(f"lookup+getattr, idle:      {_ms(idle)}")
+    print(f"lookup+getattr, transfers: {_ms(busy)} ({elapsed:.1f}s)")
+    print(f"Event {lag}")
+
+if __name__ == "__main__":
+    raise RuntimeError("This module should be run only via main.py")
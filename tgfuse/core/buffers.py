@@ -0,0 +1,466 @@
+import os, shutil, asyncio, hashlib, tempfile, contextlib
+from io import BytesIO
+from collections import OrderedDict
+
+from tgfuse.core.offload import offload
+from tgfuse.config import logging_config
+log = logging_config.setup_logging(__name__)
+
+
+# Blocking helpers, run in the worker threads
+_IO_CHUNK = 1024 * 1024
+
+
+def _write_file(path: str, data):
+    with open(path, 'wb') as out:
+        out.write(data)
+
+
+def _read_file(path: str) -> bytearray:
+    # In pieces: a single big allocation and copy would hold the GIL for long
+    data = bytearray()
+    with open(path, 'rb', buffering=0) as src:
+        while chunk := src.read(_IO_CHUNK):
+            data += chunk
+    return data
+
+
+def _pread(path: str, size: int, offset: int) -> bytes:
+    with open(path, 'rb') as src:
+        return os.pread(src.fileno(), size, offset)
+
+
+def _pwrite(path: str, data: bytes, offset: int):
+    with open(path, 'r+b') as out:
+        os.pwrite(out.fileno(), data, offset)
+
+
+def _unshare_file(path: str):
+    """Replace `path` by a copy of itself, so other hard links keep the old content."""
+    tmp = path + '.copy'
+    shutil.copyfile(path, tmp)
+    os.replace(tmp, path)
+
+
+def _fsync(path: str):
+    with contextlib.suppress(FileNotFoundError):
+        with open(path, 'rb') as src:
+            os.fsync(src.fileno())
+
+
+class BufferManager:
+    """
+    Keeps the in-RAM content buffers (`f['data']`) of all inodes under one
+    global memory budget. When the budget is exceeded, the least recently
+    used buffers are pushed out of RAM:
+      - dirty data, or data of files that are still open, is spilled to a
+        spool file and is served from disk from then on
+      - clean data of closed files goes to the disk cache (if cache is on)
+        or is dropped and downloaded again on the next open
+    The disk cache is kept under `cache_limit` bytes the same way, least
+    recently used files are removed first.
+    The writes happen in the worker threads, on buffers already detached from
+    the file dict; callers `await ready(inode)` before using a spool.
+    """
+    def __init__(self, limit: int, base_dir: str, cache_enabled: bool, cache_limit: int):
+        self._limit = limit
+        self._cache_limit = cache_limit
+        self._cache_enabled = cache_enabled
+        self._spool_dir = os.path.join(base_dir, 'spool')
+        self._cache_dir = os.path.join(base_dir, 'cache')
+        self._partial_dir = os.path.join(base_dir, 'partial')
+        os.makedirs(self._spool_dir, exist_ok=True)
+        os.makedirs(self._partial_dir, exist_ok=True)
+        if cache_enabled:
+            os.makedirs(self._cache_dir, exist_ok=True)
+
+        # inode -> file dict, least recently used first
+        self._resident = OrderedDict()
+        # inode -> bytes accounted for this inode
+        self._sizes = {}
+        self.used = 0
+        # inode -> running spill task, bytes they still hold
+        self._spills = {}
+        self.spilling = 0
+        # running disk cache writes
+        self._stores = set()
+        # cache file -> size, least recently used first
+        self._cached = OrderedDict()
+        self.cache_used = 0
+        # inode -> None or running copy; spool files that are hard links of
+        # a cache file, copied before the first write
+        self._shared = {}
+        if cache_enabled:
+            self._scan_cache()
+
+    # Accounting
+    def touch(self, inode: int, f: dict):
+        """Re-account the buffer of `inode` after a change and enforce the budget."""
+        self._account(inode, f)
+        if self.used > self._limit:
+            self._evict()
+
+    def _account(self, inode: int, f: dict):
+        size = 0 if f['spool'] else len(f['data'])
+        self.used += size - self._sizes.get(inode, 0)
+        if size:
+            self._sizes[inode] = size
+            self._resident[inode] = f
+            self._resident.move_to_end(inode)
+        else:
+            self._sizes.pop(inode, None)
+            self._resident.pop(inode, None)
+
+    def _evict(self):
+        for inode in list(self._resident):
+            if self.used <= self._limit:
+                break
+            f = self._resident[inode]
+            if f['dirty'] or f['refcount'] > 0:
+                self._spill(inode, f)
+            elif self._cache_enabled and f['file_id'] is not None:
+                self._store_cached(f['file_id'], f['data'])
+                log.debug(f"Evicted inode={inode} to disk cache.")
+            else:
+                log.debug(f"Dropped clean buffer of inode={inode}.")
+            f['data'] = bytearray()
+            self._account(inode, f)
+
+    def _spill(self, inode: int, f: dict):
+        """Point `inode` at a new spool file and write its RAM data there in the background."""
+        fd, path = tempfile.mkstemp(dir=self._spool_dir, prefix=f"{inode}-")
+        os.close(fd)
+        data = f['data']
+        f['spool'] = path
+        f['data'] = bytearray()
+        self.spilling += len(data)
+        task = asyncio.create_task(offload.run(_write_file, path, data))
+        self._spills[inode] = task
+        task.add_done_callback(lambda t: self._spilled(inode, f, path, data, t))
+
+    def _spilled(self, inode: int, f: dict, path: str, data: bytearray, task: asyncio.Task):
+        self.spilling -= len(data)
+        if self._spills.get(inode) is task:
+            del self._spills[inode]
+        if f['spool'] != path:
+            # Dropped meanwhile
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            return
+        error = None if task.cancelled() else task.exception()
+        if task.cancelled() or error:
+            # Keep the data in RAM rather than lose it
+            log.error(f"Spilling inode={inode} to {path} failed: {error}")
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            f['spool'] = None
+            f['data'] = data
+            self._account(inode, f)
+            return
+        log.debug(f"Spilled {len(data)} bytes of inode={inode} to {path}.")
+
+    async def ready(self, inode: int):
+        """Wait until a spill of `inode` has reached its spool file."""
+        task = self._spills.get(inode)
+        if task is not None:
+            await asyncio.wait([task])
+
+    async def drain(self):
+        """Hold back writers while more than the budget waits to be spilled."""
+        while self.spilling > self._limit and self._spills:
+            await asyncio.wait(
+                list(self._spills.values()), return_when=asyncio.FIRST_COMPLETED
+            )
+
+    async def persist(self, inode: int, f: dict):
+        """Make sure the content of `inode` is in a spool file that survives a crash."""
+        if not f['spool']:
+            self._spill(inode, f)
+            self._account(inode, f)
+        await self.ready(inode)
+        if not f['spool']:
+            raise OSError(f"Couldn't spool inode={inode}.")
+        await offload.run(_fsync, f['spool'])
+
+    def adopt_spool(self, inode: int, f: dict, path: str):
+        """Use an existing spool file (e.g. from the upload journal) as content."""
+        f['spool'] = path
+        f['data'] = bytearray()
+        self._account(inode, f)
+
+    # Disk cache
+    def _cache_path(self, file_id: str) -> str:
+        name = hashlib.sha1(file_id.encode('utf-8')).hexdigest()
+        return os.path.join(self._cache_dir, name)
+
+    def _scan_cache(self):
+        """Account the files left in the disk cache by earlier runs, oldest first."""
+        entries = []
+        for entry in os.scandir(self._cache_dir):
+            with contextlib.suppress(OSError):
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.path, st.st_size))
+        for _, path, size in sorted(entries):
+            self._cached[path] = size
+            self.cache_used += size
+        self._prune_cache()
+
+    def _cache_added(self, path: str):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        self.cache_used += size - self._cached.pop(path, 0)
+        self._cached[path] = size
+        self._prune_cache()
+
+    def _cache_hit(self, path: str):
+        if path in self._cached:
+            self._cached.move_to_end(path)
+            # The order survives a restart via mtime
+            with contextlib.suppress(OSError):
+                os.utime(path)
+
+    def _prune_cache(self):
+        while self.cache_used > self._cache_limit and self._cached:
+            path, size = self._cached.popitem(last=False)
+            self.cache_used -= size
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            log.debug(f"Pruned {size} bytes from the disk cache.")
+
+    def _store_cached(self, file_id: str, data: bytearray):
+        path = self._cache_path(file_id)
+        if os.path.exists(path):
+            return
+        task = asyncio.create_task(offload.run(self._write_cached, path, data))
+        self._stores.add(task)
+        task.add_done_callback(self._stores.discard)
+        task.add_done_callback(lambda _: self._cache_added(path))
+
+    def _write_cached(self, path: str, data: bytearray):
+        fd, tmp = tempfile.mkstemp(dir=self._cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning(f"Writing cache file {path} failed: {e}")
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+
+    def rekey(self, old_id: str | None, new_id: str):
+        """Move the disk cache and partial download of a file to its new file_id."""
+        if old_id is None:
+            return
+        for path_of in (self._cache_path, self.partial_path):
+            with contextlib.suppress(OSError):
+                os.replace(path_of(old_id), path_of(new_id))
+        old = self._cache_path(old_id)
+        if old in self._cached:
+            self.cache_used -= self._cached.pop(old)
+            self._cache_added(self._cache_path(new_id))
+
+    def partial_path(self, file_id: str) -> str:
+        """Where an unfinished download of `file_id` is kept between attempts."""
+        name = hashlib.sha1(file_id.encode('utf-8')).hexdigest()
+        return os.path.join(self._partial_dir, name)
+
+    async def adopt_download(self, inode: int, f: dict, path: str):
+        """Take a finished download: into RAM if it fits the budget, else as spool."""
+        size = os.path.getsize(path)
+        if self.used + size <= self._limit:
+            file_id = f['file_id']
+            data = await offload.run(_read_file, path)
+            os.unlink(path)
+            # Truncated, re-uploaded or loaded otherwise meanwhile
+            if f['file_id'] == file_id and not self.is_loaded(f):
+                f['data'] = data
+                self.touch(inode, f)
+            return
+        fd, spool = tempfile.mkstemp(dir=self._spool_dir, prefix=f"{inode}-")
+        os.close(fd)
+        os.replace(path, spool)
+        self.adopt_spool(inode, f, spool)
+        log.debug(f"Download of inode={inode} ({size} bytes) kept as spool {spool}.")
+
+    async def load_cached(self, inode: int, f: dict) -> bool:
+        """Fill the buffer of `inode` from the disk cache, if it has a copy."""
+        if not self._cache_enabled or f['file_id'] is None:
+            return False
+        file_id = f['file_id']
+        path = self._cache_path(file_id)
+        if not os.path.exists(path):
+            return False
+        try:
+            if self.used + os.path.getsize(path) > self._limit:
+                # Doesn't fit the budget => serve it from disk, like a big download
+                return await self._link_cached(inode, f, path)
+            data = await offload.run(_read_file, path)
+        except FileNotFoundError:
+            return False
+        if f['file_id'] != file_id or self.is_loaded(f):
+            return True
+        self._cache_hit(path)
+        f['data'] = data
+        self.touch(inode, f)
+        log.debug(f"Loaded {len(f['data'])} bytes for inode={inode} from disk cache.")
+        return True
+
+    async def _link_cached(self, inode: int, f: dict, path: str) -> bool:
+        file_id = f['file_id']
+        fd, spool = tempfile.mkstemp(dir=self._spool_dir, prefix=f"{inode}-")
+        os.close(fd)
+        shared = True
+        try:
+            os.link(path, spool + '.link')
+            os.replace(spool + '.link', spool)
+        except FileNotFoundError:
+            os.unlink(spool)
+            return False
+        except OSError:
+            # No hard links on this filesystem
+            await offload.run(shutil.copyfile, path, spool)
+            shared = False
+        if f['file_id'] != file_id or self.is_loaded(f):
+            os.unlink(spool)
+            return True
+        self._cache_hit(path)
+        self.adopt_spool(inode, f, spool)
+        if shared:
+            self._shared[inode] = None
+        log.debug(f"Serving inode={inode} from disk cache as spool {spool}.")
+        return True
+
+    # Buffer access
+    def is_loaded(self, f: dict) -> bool:
+        return f['spool'] is not None or len(f['data']) > 0
+
+    def length(self, f: dict) -> int:
+        if f['spool']:
+            return os.path.getsize(f['spool'])
+        return len(f['data'])
+
+    async def read(self, inode: int, f: dict, offset: int, size: int) -> bytes:
+        if f['spool']:
+            return await offload.run(_pread, f['spool'], size, offset)
+        if inode in self._resident:
+            self._resident.move_to_end(inode)
+        return bytes(f['data'][offset:offset+size])
+
+    async def _unshare(self, inode: int, f: dict):
+        task = self._shared[inode]
+        if task is None:
+            task = asyncio.create_task(offload.run(_unshare_file, f['spool']))
+            self._shared[inode] = task
+        try:
+            await task
+        except OSError:
+            self._shared[inode] = None
+            raise
+        self._shared.pop(inode, None)
+
+    async def write(self, inode: int, f: dict, offset: int, data: bytes):
+        if inode in self._shared:
+            await self._unshare(inode, f)
+        if f['spool']:
+            await offload.run(_pwrite, f['spool'], data, offset)
+            return
+        buf = f['data']
+        end = offset + len(data)
+        if offset > len(buf):
+            buf.extend(b"\0" * (offset - len(buf)))
+        buf[offset:end] = data
+        self.touch(inode, f)
+
+    def upload_source(self, f: dict):
+        """Object to hand to `send_document`: the spool path or an in-memory copy."""
+        if f['spool']:
+            return f['spool']
+        return BytesIO(f['data'])
+
+    def settle(self, inode: int, f: dict):
+        """
+        Called once `inode` is closed and has no pending changes.
+        With cache off the content is dropped, with cache on a spooled copy
+        moves into the disk cache and RAM data stays until evicted.
+        """
+        if f['refcount'] > 0:
+            return
+        if inode in self._spills:
+            # Once the spool is complete, unless written to again meanwhile
+            self._spills[inode].add_done_callback(
+                lambda _: None if f['dirty'] else self.settle(inode, f)
+            )
+            return
+        if not self._cache_enabled:
+            self.drop(inode, f)
+            return
+        if inode in self._shared:
+            # Unchanged cache file => just forget the extra link
+            self.drop(inode, f)
+            return
+        if f['spool']:
+            if f['file_id'] is not None:
+                path = self._cache_path(f['file_id'])
+                os.replace(f['spool'], path)
+                f['spool'] = None
+                self._cache_added(path)
+            else:
+                self.drop(inode, f)
+
+    def drop(self, inode: int, f: dict):
+        """Forget the content of `inode`, both in RAM and spooled."""
+        self._shared.pop(inode, None)
+        if f['spool']:
+            with contextlib.suppress(OSError):
+                os.unlink(f['spool'])
+            f['spool'] = None
+        f['data'] = bytearray()
+        self.touch(inode, f)
+
+    async def close(self):
+        """Wait for the spills and cache writes still running, e.g. on unmount."""
+        tasks = list(self._spills.values()) + list(self._stores)
+        if tasks:
+            await asyncio.wait(tasks)
+
+class HeadCache:
+    """
+    First chunk of files, kept apart from the content buffers. Type sniffing
+    (`file`, file managers, media scanners) mostly reads only the start of a
+    file, this serves it without a full download.
+    """
+    def __init__(self, limit: int):
+        self._limit = limit
+        # inode -> bytes, least recently used first
+        self._heads = OrderedDict()
+        self.used = 0
+
+    def __contains__(self, inode: int) -> bool:
+        return inode in self._heads
+
+    def has_room(self, size: int) -> bool:
+        return self.used + size <= self._limit
+
+    def get(self, inode: int) -> bytes | None:
+        head = self._heads.get(inode)
+        if head is not None:
+            self._heads.move_to_end(inode)
+        return head
+
+    def put(self, inode: int, head: bytes):
+        self.forget(inode)
+        self._heads[inode] = head
+        self.used += len(head)
+        while self.used > self._limit and len(self._heads) > 1:
+            _, old = self._heads.popitem(last=False)
+            self.used -= len(old)
+
+    def forget(self, inode: int):
+        old = self._heads.pop(inode, None)
+        if old is not None:
+            self.used -= len(old)
+
+if __name__ == "__main__":
+    raise RuntimeError("This module should be run only via main.py")
@@ -1,8 +1,11 @@
+import logging
 from pyftpdlib.authorizers import DummyAuthorizer
 from pyftpdlib.handlers import FTPHandler
 from pyftpdlib.servers import FTPServer
+from pyftpdlib.log import config_logging
 from tgfuse.config import logging_config
 log = logging_config.setup_logging(__name__)
+config_logging(level=logging.ERROR, prefix='%(levelname)s: %(module)s: %(message)s')
 
 def ftp_server(mount_path: str):
     authorizer = DummyAuthorizer()
@@ -1,8 +1,14 @@
 import os, stat, errno, asyncio, time, contextlib
 
-from pyrogram.errors import RPCError, ChatWriteForbidden, MessageDeleteForbidden
+from pyrogram.errors import RPCError, FloodWait, ChatWriteForbidden, MessageDeleteForbidden
 
 from tgfuse.funcs.channel import gather_all_docs
+from tgfuse.funcs.index import load_index, save_index
+from tgfuse.core.buffers import BufferManager, HeadCache
+from tgfuse.core.journal import UploadJournal
+from tgfuse.core.ratelimit import limiter
+from tgfuse.core.batcher import DeleteBatcher
+from tgfuse.core.offload import offload, LoopMonitor
 
 import pyfuse3
 import pyfuse3.asyncio
@@ -11,15 +17,44 @@ pyfuse3.asyncio.enable()
 from pyfuse3 import FUSEError, ROOT_INODE, FileInfo, EntryAttributes
 from typing import Sequence, Tuple
 
+from tgfuse.config.config import Config
 from tgfuse.config import logging_config
 log = logging_config.setup_logging(__name__)
 
+# stream_media() hands out files in chunks of this size
+DOWNLOAD_CHUNK = 1024 * 1024
+# A failing chunk (dropped connection, timeout, ...) is retried this many
+# times, after 1, 2, 4, ... seconds, before the request gets EIO
+DOWNLOAD_RETRIES = 5
+
+
+def _append_chunk(out, chunk: bytes):
+    out.write(chunk)
+    out.flush()
+
+
+async def _retry_later(inode: int, attempt: int, error: Exception):
+    if attempt > DOWNLOAD_RETRIES:
+        log.error(f"Download inode={inode} failed {DOWNLOAD_RETRIES} times, last: {error!r}")
+        raise FUSEError(errno.EIO) from error
+    delay = 2 ** (attempt - 1)
+    log.warning(
+        f"Download inode={inode} failed ({error!r}) => retry {attempt}/{DOWNLOAD_RETRIES} in {delay}s."
+    )
+    await asyncio.sleep(delay)
+
+
 class TelegramFS(pyfuse3.Operations):
-    def __init__(self, client, chat_id: int, read_only: bool, cache_enabled: bool):
+    def __init__(self, client, chats: list, cache_enabled: bool, spread: bool = False):
+        """
+        `chats` is a list of (chat_id, title, read_only). One channel is served
+        at the root; several become one directory each, or with `spread` a single
+        merged root whose new files go to the writable channels in turn.
+        """
         super().__init__()
         self._tg_client = client
-        self._chat_id = chat_id
-        self.read_only = read_only
+        # Read-only only if no channel can be written
+        self.read_only = all(ro for (_, _, ro) in chats)
 
         self.enable_writeback_cache = False
         self.supports_dot_lookup = False
@@ -28,136 +63,313 @@ class TelegramFS(pyfuse3.Operations):
         self._next_inode = 2
         self._cache_enabled = cache_enabled
 
-        # name -> inode
-        self._name_to_inode = {}
-        # message_id -> inode
-        self._msg_id_to_inode = {}
+        # directory inode -> { name: inode }
+        self._dirs = {self._root_inode: {}}
+        # directory inode -> chat_id of the files created in it (None => round-robin)
+        self._dir_chat = {}
+        # chat_id -> {
+        #   'read_only': bool,
+        #   'dir_inode': int,
+        #   'msg_to_inode': { message_id: inode },
+        #   'deletes': DeleteBatcher
+        # }
+        self._channels = {}
+        self._spread = spread and len(chats) > 1
+        self._next_spread = 0
+        for (chat_id, title, ro) in chats:
+            dir_inode = self._root_inode
+            if len(chats) > 1 and not self._spread:
+                dir_inode = self._next_inode
+                self._next_inode += 1
+                dname = (title or str(chat_id)).replace('/', '_').encode('utf-8')
+                dname = self._unique_file_name(self._root_inode, dname)
+                self._dirs[self._root_inode][dname] = dir_inode
+                self._dirs[dir_inode] = {}
+            self._dir_chat[dir_inode] = None if self._spread else chat_id
+            self._channels[chat_id] = {
+                'read_only': ro,
+                'dir_inode': dir_inode,
+                'msg_to_inode': {},
+                # unlink() => message deletions, sent in batches
+                'deletes': DeleteBatcher(client, chat_id),
+            }
 
         # inode -> {
+        #   'chat_id': int,
+        #   'parent': int (directory inode),
         #   'message_id': int or None,
         #   'file_id': str or None,
         #   'file_name': bytes,
         #   'size': int,
         #   'timestamp': int,
+        #   'mime_type': str or None,
         #   'data': bytearray,
+        #   'spool': str or None (content spilled to disk instead of 'data'),
         #   'dirty': bool,
-        #   'refcount': int
+        #   'refcount': int,
+        #   'read_only': bool,
+        #   'journal': str or None (id of the pending upload entry)
         # }
         self._files = {}
+        # RAM budget for all 'data' buffers
+        self._buffers = BufferManager(
+            Config.mem_limit * 1024 * 1024, Config.cache_dir, cache_enabled,
+            Config.cache_limit * 1024 * 1024
+        )
+        # Pending uploads that have to survive a crash/restart
+        self._journal = UploadJournal(Config.cache_dir)
+        # Running downloads => { inode: asyncio.Task }
+        self._downloads = {}
+        # First chunk of files, for reads that only sniff the file type
+        self._heads = HeadCache(Config.head_cache * 1024 * 1024)
+        # Running head fetches => { inode: asyncio.Task }
+        self._head_fetches = {}
+        self._prefetch_task = None
 
         # For delayed uploads of new files => { inode: asyncio.Task }
         self._delayed_upload_tasks = {}
         # For channel sync
         self._sync_task = None
+        # Queued/running uploads, `write` waits while there are too many
+        self._pending_uploads = 0
+        self._upload_room = asyncio.Event()
+        self._upload_room.set()
 
         # fh -> inode
         self._fh_to_inode = {}
         self._next_fh = 1
 
+        # How long FUSE requests wait for the event loop
+        self._loop_monitor = LoopMonitor()
+
     async def init_fs(self):
-        """Gather initial docs, then start periodic sync."""
-        await self._sync_initial_docs()
+        """
+        Serve the index cached by the last run right away, the full sync
+        (followed by resuming journaled uploads) runs in the background.
+        """
+        self._load_cached_index()
+        self._loop_monitor.start()
         self._sync_task = asyncio.create_task(self._periodic_sync_task())
 
     async def destroy(self):
         """Called on unmount => stop background tasks."""
+        if self._prefetch_task:
+            self._prefetch_task.cancel()
         if self._sync_task:
             self._sync_task.cancel()
             with contextlib.suppress(asyncio.CancelledError):
                 await self._sync_task
+        for ch in self._channels.values():
+            await ch['deletes'].close()
+        await self._buffers.close()
+        await self._loop_monitor.stop()
+        log.info(f"Event {self._loop_monitor.report()}")
         log.info("destroy() done - FS unmounted.")
 
-    async def _sync_initial_docs(self):
-        log.info("Initial sync: gather existing docs from channel...")
-        docs = await gather_all_docs(self._tg_client, self._chat_id)
-        for (m_id, f_id, fname_b, size, ts) in docs:
-            inode = self._next_inode
-            self._next_inode += 1
-
-            unique_fname = self._unique_file_name(fname_b)
-            self._files[inode] = {
-                'message_id': m_id,
-                'file_id': f_id,
-                'file_name': unique_fname,
-                'size': size,
-                'timestamp': ts,
-                'data': bytearray(),
-                'dirty': False,
-                'refcount': 0,
-                'read_only': False
-            }
-            self._name_to_inode[unique_fname] = inode
-            self._msg_id_to_inode[m_id] = inode
+    def _load_cached_index(self):
+        for chat_id, ch in self._channels.items():
+            docs = load_index(Config.cache_dir, chat_id) or []
+            for (m_id, f_id, fname_b, size, ts, mime) in docs:
+                self._add_file(chat_id, ch['dir_inode'], m_id, f_id, fname_b, size, ts, mime)
+        log.info(f"Loaded {len(self._files)} files from the cached index.")
+
+    async def _initial_sync(self):
+        log.info(f"Initial sync: gather existing docs from {len(self._channels)} channel(s)...")
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(self._sync_channel_updates(chat_id, background=False) for chat_id in self._channels)
+        )
+        log.info(
+            f"Initial sync done in {time.perf_counter() - started:.2f}s, {len(self._files)} files."
+        )
+        self._replay_journal()
+
+    def _replay_journal(self):
+        """Queue again the uploads that were still pending when tgfuse stopped."""
+        for chat_id, ch in self._channels.items():
+            for entry_id, entry in self._journal.entries(chat_id):
+                self._replay_entry(chat_id, ch, entry_id, entry)
+
+    def _replay_entry(self, chat_id: int, ch: dict, entry_id: str, entry: dict):
+        if not os.path.exists(entry['spool']):
+            log.warning(f"Journal entry {entry_id} lost its spool file => drop.")
+            self._journal.remove(entry_id)
+            return
 
-        log.info(f"Initial sync done, loaded {len(self._files)} files.")
+        inode = ch['msg_to_inode'].get(entry['message_id'])
+        if inode is None:
+            # Old message is already gone (or there never was one) => new file
+            inode = self._add_file(
+                chat_id, ch['dir_inode'], None, None, entry['name'], 0, int(time.time())
+            )
+
+        f = self._files[inode]
+        self._buffers.adopt_spool(inode, f, entry['spool'])
+        f['size'] = self._buffers.length(f)
+        f['dirty'] = True
+        f['journal'] = entry_id
+        log.info(f"Resuming upload from journal => inode={inode}, name={f['file_name']}")
+        self._start_upload(inode, delay_s=0)
 
     async def _periodic_sync_task(self):
-        """Runs every 30s, checks for new/removed docs in the channel."""
+        """Initial sync, then every 30s, checks for new/removed docs in the channels."""
+        synced = False
+        first = True
         while True:
             try:
-                await asyncio.sleep(30)
-                await self._sync_channel_updates()
+                if not first:
+                    await asyncio.sleep(30)
+                first = False
+                if not synced:
+                    await self._initial_sync()
+                    synced = True
+                    continue
+                for chat_id in self._channels:
+                    await self._sync_channel_updates(chat_id)
+                log.debug(f"Event {self._loop_monitor.report()}")
             except asyncio.CancelledError:
                 log.info("Background sync task cancelled.")
                 return
             except Exception as e:
                 log.exception(f"Periodic sync task error: {e}")
 
-    async def _sync_channel_updates(self):
+    async def _sync_channel_updates(self, chat_id: int, background: bool = True):
         """Add new docs & remove missing docs from local state."""
-        log.debug("Syncing channel updates...")
-        docs = await gather_all_docs(self._tg_client, self._chat_id)
+        log.debug(f"Syncing channel updates chat_id={chat_id}...")
+        ch = self._channels[chat_id]
+        docs = await gather_all_docs(self._tg_client, chat_id, background=background)
+        await offload.run(save_index, Config.cache_dir, chat_id, docs)
         current_msgs = {}
-        for (m_id, f_id, fname_b, size, ts) in docs:
-            current_msgs[m_id] = (f_id, fname_b, size, ts)
+        for (m_id, f_id, fname_b, size, ts, mime) in docs:
+            current_msgs[m_id] = (f_id, fname_b, size, ts, mime)
 
-        old_msg_ids = set(self._msg_id_to_inode.keys())
+        old_msg_ids = set(ch['msg_to_inode'].keys())
         new_msg_ids = set(current_msgs.keys())
+        # Unlinked files wait for their batched delete, failed ones come back
+        ch['deletes'].reconcile(new_msg_ids)
+        new_msg_ids -= ch['deletes'].pending
 
         # removed
         removed = old_msg_ids - new_msg_ids
         for msg_id in removed:
-            inode = self._msg_id_to_inode[msg_id]
+            inode = ch['msg_to_inode'][msg_id]
             info = self._files.get(inode)
             if not info:
                 continue
             if info['refcount'] > 0:
                 log.debug(f"Skipping removal inode={inode}, msg_id={msg_id} because open.")
                 continue
-            fname = info['file_name']
-            log.info(f"Doc removed => inode={inode} name={fname}.")
-            self._files.pop(inode, None)
-            self._name_to_inode.pop(fname, None)
-            self._msg_id_to_inode.pop(msg_id, None)
+            log.info(f"Doc removed => inode={inode} name={info['file_name']}.")
+            self._remove_file(inode)
 
         # added
         added = new_msg_ids - old_msg_ids
         for msg_id in added:
-            (f_id, fname_b, size, ts) = current_msgs[msg_id]
-            inode = self._next_inode
-            self._next_inode += 1
-            unique_fname = self._unique_file_name(fname_b)
-            self._files[inode] = {
-                'message_id': msg_id,
-                'file_id': f_id,
-                'file_name': unique_fname,
-                'size': size,
-                'timestamp': ts,
-                'data': bytearray(),
-                'dirty': False,
-                'refcount': 0
-            }
-            self._name_to_inode[unique_fname] = inode
-            self._msg_id_to_inode[msg_id] = inode
-            log.info(f"New doc => inode={inode}, name={unique_fname}, msg_id={msg_id}")
+            (f_id, fname_b, size, ts, mime) = current_msgs[msg_id]
+            inode = self._add_file(chat_id, ch['dir_inode'], msg_id, f_id, fname_b, size, ts, mime)
+            log.info(f"New doc => inode={inode}, name={self._files[inode]['file_name']}, msg_id={msg_id}")
+
+        # still there => refresh what an index from the last run may have stale
+        for msg_id in old_msg_ids & new_msg_ids:
+            self._refresh_file(ch['msg_to_inode'][msg_id], current_msgs[msg_id])
 
         log.debug("Channel sync complete.")
+        self._schedule_head_prefetch()
 
-    def _unique_file_name(self, fname: bytes) -> bytes:
+    def _refresh_file(self, inode: int, doc: tuple):
+        """
+        Take the current file_id (its file_reference expires), size and mime
+        type of a known message. Local changes and running downloads win.
+        """
+        f = self._files.get(inode)
+        if not f or f['dirty'] or inode in self._downloads:
+            return
+        (f_id, _, size, _, mime) = doc
+        f['mime_type'] = mime
+        if f['size'] != size:
+            # Media replaced => cached content is stale
+            log.info(f"Doc changed => inode={inode}, name={f['file_name']}.")
+            self._heads.forget(inode)
+            if f['refcount'] == 0:
+                self._buffers.drop(inode, f)
+            f['size'] = size
+        elif f['file_id'] != f_id:
+            # Same content => keep the disk cache and partial download
+            self._buffers.rekey(f['file_id'], f_id)
+        f['file_id'] = f_id
+
+    def _schedule_head_prefetch(self):
+        """With HEAD_PREFETCH, fetch small files' first chunk in the background."""
+        if not Config.head_prefetch:
+            return
+        if self._prefetch_task and not self._prefetch_task.done():
+            return
+        max_size = Config.head_prefetch * 1024
+        inodes = [
+            inode for inode, f in self._files.items()
+            if f['file_id'] is not None and 0 < f['size'] <= max_size and inode not in self._heads
+        ]
+        if inodes:
+            self._prefetch_task = asyncio.create_task(self._prefetch_heads(inodes))
+
+    async def _prefetch_heads(self, inodes: list):
+        log.debug(f"Prefetching heads of {len(inodes)} small files.")
+        for inode in inodes:
+            f = self._files.get(inode)
+            if f is None or f['file_id'] is None:
+                continue
+            if not self._heads.has_room(f['size']):
+                log.debug("Head cache full => stop prefetching.")
+                return
+            try:
+                await self._fetch_head(inode, background=True)
+            except FUSEError as e:
+                log.debug(f"Head prefetch failed inode={inode}: {e}")
+
+    def _add_file(
+        self, chat_id: int, parent: int, m_id, f_id, fname: bytes, size: int, ts: int,
+        mime: str | None = None, refcount: int = 0
+    ) -> int:
+        """Register a file under a unique name in `parent`, returns its inode."""
+        inode = self._next_inode
+        self._next_inode += 1
+        unique_fname = self._unique_file_name(parent, fname)
+        self._files[inode] = {
+            'chat_id': chat_id,
+            'parent': parent,
+            'message_id': m_id,
+            'file_id': f_id,
+            'file_name': unique_fname,
+            'size': size,
+            'timestamp': ts,
+            'mime_type': mime,
+            'data': bytearray(),
+            'spool': None,
+            'dirty': False,
+            'refcount': refcount,
+            'read_only': False,
+            'journal': None
+        }
+        self._dirs[parent][unique_fname] = inode
+        if m_id:
+            self._channels[chat_id]['msg_to_inode'][m_id] = inode
+        return inode
+
+    def _remove_file(self, inode: int):
+        f = self._files.pop(inode)
+        self._buffers.drop(inode, f)
+        self._heads.forget(inode)
+        self._dirs[f['parent']].pop(f['file_name'], None)
+        self._channels[f['chat_id']]['msg_to_inode'].pop(f['message_id'], None)
+
+    def _is_read_only(self, f: dict) -> bool:
+        return self._channels[f['chat_id']]['read_only'] or f.get('read_only', False)
+
+    def _unique_file_name(self, parent: int, fname: bytes) -> bytes:
         """If conflict, append _2, _3, etc."""
         base = fname
         idx = 2
-        while fname in self._name_to_inode:
+        while fname in self._dirs[parent]:
             fname = base + f"_{idx}".encode('utf-8')
             idx += 1
         return fname
@@ -165,46 +377,172 @@ class TelegramFS(pyfuse3.Operations):
     # Read/Write Helpers
     async def _download_if_needed(self, inode: int):
         f = self._files[inode]
-        if len(f['data']) == 0 and f['file_id'] is not None and f['size'] > 0:
-            log.debug(f"Downloading content inode={inode}, file_id={f['file_id']}")
-            bio = await self._tg_client.download_media(f['file_id'], in_memory=True)
-            bio.seek(0)
-            f['data'] = bytearray(bio.read())
-            log.debug(f"Downloaded {len(f['data'])} bytes for inode={inode}.")
+        if self._buffers.is_loaded(f) or f['file_id'] is None or f['size'] == 0:
+            return
+        if await self._buffers.load_cached(inode, f):
+            return
+
+        task = self._downloads.get(inode)
+        if task is None:
+            task = asyncio.create_task(self._download(inode, f['file_id']))
+            self._downloads[inode] = task
+            task.add_done_callback(lambda _: self._downloads.pop(inode, None))
+        # Shielded => an interrupted request doesn't abort the download for others
+        await asyncio.shield(task)
+
+    async def _read_head(self, inode: int) -> bytes:
+        """First chunk of `inode`, one small request instead of a full download."""
+        head = self._heads.get(inode)
+        if head is not None:
+            return head
+        task = self._head_fetches.get(inode)
+        if task is None:
+            task = asyncio.create_task(self._fetch_head(inode))
+            self._head_fetches[inode] = task
+            task.add_done_callback(lambda _: self._head_fetches.pop(inode, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_head(self, inode: int, background: bool = False) -> bytes:
+        f = self._files[inode]
+        file_id = f['file_id']
+        attempt = 0
+        while True:
+            try:
+                await limiter.wait('file', background)
+                head = b''
+                async for chunk in self._tg_client.stream_media(file_id, limit=1):
+                    head = bytes(chunk)
+                limiter.success('file')
+                break
+            except FloodWait as e:
+                limiter.flood_wait('file', int(e.value))
+            except Exception as e:
+                attempt += 1
+                await _retry_later(inode, attempt, e)
+
+        if f['file_id'] != file_id:
+            # Changed while fetching
+            return head
+        self._heads.put(inode, head)
+        log.debug(f"Fetched head of inode={inode}, {len(head)} bytes.")
+
+        # A full first chunk also seeds the resumable download
+        path = self._buffers.partial_path(file_id)
+        if len(head) == DOWNLOAD_CHUNK and inode not in self._downloads and not os.path.exists(path):
+            tmp = f"{path}.{inode}.tmp"
+            with open(tmp, 'wb') as out:
+                await offload.run(_append_chunk, out, head)
+            # A download may have started while writing
+            if inode in self._downloads or os.path.exists(path):
+                os.unlink(tmp)
+            else:
+                os.replace(tmp, path)
+        return head
+
+    async def _download(self, inode: int, file_id: str):
+        """
+        Stream `file_id` into a partial file chunk by chunk. Complete chunks stay
+        on disk, so a failed or interrupted download continues from the last
+        one on the next attempt, even after a restart.
+        """
+        f = self._files[inode]
+        path = self._buffers.partial_path(file_id)
+        done = os.path.getsize(path) if os.path.exists(path) else 0
+        chunks = done // DOWNLOAD_CHUNK
+
+        with open(path, 'a+b') as out:
+            # Drop a torn last chunk
+            out.truncate(chunks * DOWNLOAD_CHUNK)
+            if chunks:
+                log.debug(f"Resuming download inode={inode} from chunk {chunks}.")
+            else:
+                log.debug(f"Downloading content inode={inode}, file_id={file_id}")
+            attempt = 0
+            failed_at = -1
+            while chunks * DOWNLOAD_CHUNK < f['size']:
+                try:
+                    await limiter.wait('file')
+                    async for chunk in self._tg_client.stream_media(file_id, offset=chunks):
+                        await offload.run(_append_chunk, out, chunk)
+                        chunks += 1
+                        limiter.success('file')
+                        await limiter.wait('file')
+                    break
+                # Both resume after the last complete chunk
+                except FloodWait as e:
+                    limiter.flood_wait('file', int(e.value))
+                except Exception as e:
+                    # Count only failures in a row without progress
+                    attempt = attempt + 1 if chunks == failed_at else 1
+                    failed_at = chunks
+                    out.truncate(chunks * DOWNLOAD_CHUNK)
+                    await _retry_later(inode, attempt, e)
+            out.flush()
+            size = os.fstat(out.fileno()).st_size
+
+        log.debug(f"Downloaded {size} bytes for inode={inode}.")
+        if size != f['size']:
+            log.warning(f"Size mismatch inode={inode}: got {size}, expected {f['size']}.")
+
+        # The file may have been truncated or re-uploaded meanwhile
+        if inode in self._files and f['file_id'] == file_id and not self._buffers.is_loaded(f):
+            await self._buffers.adopt_download(inode, f, path)
+            if inode not in self._files:
+                # Unlinked while loading
+                self._buffers.drop(inode, f)
+        else:
+            os.unlink(path)
 
     async def _upload_existing_file(self, inode: int):
         f = self._files[inode]
         old_mid = f['message_id']
         if old_mid:
             try:
-                await self._tg_client.delete_messages(self._chat_id, old_mid)
+                await limiter.call(
+                    'delete', self._tg_client.delete_messages, f['chat_id'], old_mid,
+                    scope=f['chat_id']
+                )
             except RPCError as e:
                 log.warning(
                     "Can't delete msg_id=%s (%s) – mark read‑only.", old_mid, e
                 )
                 f['read_only'] = True
                 f['dirty'] = False
+                # Changes can't be stored => back to the content in Telegram
+                self._journal.remove(f['journal'])
+                f['journal'] = None
+                self._buffers.drop(inode, f)
                 return
+            self._channels[f['chat_id']]['msg_to_inode'].pop(old_mid, None)
 
-        size = len(f['data'])
+        await self._buffers.ready(inode)
+        size = self._buffers.length(f)
         if size == 0:
             log.debug(f"Skipping upload for zero-length inode={inode}.")
             f['dirty'] = False
             f['size'] = 0
+            self._upload_done(inode, f)
             return
 
-        from io import BytesIO
-        b = BytesIO(f['data'])
-        b.name = f['file_name'].decode('utf-8', 'replace')
-
         try:
-            msg = await self._tg_client.send_document(self._chat_id, document=b)
+            msg = await limiter.call(
+                'send',
+                self._tg_client.send_document,
+                f['chat_id'],
+                document=self._buffers.upload_source(f),
+                file_name=f['file_name'].decode('utf-8', 'replace'),
+                scope=f['chat_id']
+            )
+            # Sent => a restart must not send it again, whatever fails below
+            self._journal.remove(f['journal'])
+            f['journal'] = None
             f['file_id'] = msg.document.file_id
+            f['mime_type'] = msg.document.mime_type
             f['message_id'] = msg.id
             f['size'] = size
             f['timestamp'] = int(time.time())
             f['dirty'] = False
-            self._msg_id_to_inode[msg.id] = inode
+            self._channels[f['chat_id']]['msg_to_inode'][msg.id] = inode
             log.debug(f"Re-upload => inode={inode}, msg_id={msg.id}")
         except RPCError as e:
             log.error(
@@ -212,9 +550,8 @@ class TelegramFS(pyfuse3.Operations):
             )
             f['read_only'] = True
         finally:
-            # If cache is off and file is still closed, clear out the data
-            if f['refcount'] == 0 and not self._cache_enabled:
-                f['data'].clear()
+            if not f['dirty']:
+                self._upload_done(inode, f)
 
     async def _delayed_upload_new_file(self, inode: int, delay_s: int = 5):
         log.debug(f"Inode={inode} => new => delay {delay_s}s.")
@@ -232,23 +569,32 @@ class TelegramFS(pyfuse3.Operations):
             log.debug(f"Inode={inode} no longer new or not dirty => skip.")
             return
 
-        size = len(f['data'])
+        await self._buffers.ready(inode)
+        size = self._buffers.length(f)
         if size == 0:
             log.debug(f"Zero-length inode={inode}, skip upload.")
+            self._upload_done(inode, f)
             return
 
-        from io import BytesIO
-        b = BytesIO(f['data'])
-        b.name = f['file_name'].decode('utf-8', 'replace')
-
         try:
-            msg = await self._tg_client.send_document(self._chat_id, document=b)
+            msg = await limiter.call(
+                'send',
+                self._tg_client.send_document,
+                f['chat_id'],
+                document=self._buffers.upload_source(f),
+                file_name=f['file_name'].decode('utf-8', 'replace'),
+                scope=f['chat_id']
+            )
+            # Sent => a restart must not send it again, whatever fails below
+            self._journal.remove(f['journal'])
+            f['journal'] = None
             f['file_id'] = msg.document.file_id
+            f['mime_type'] = msg.document.mime_type
             f['message_id'] = msg.id
             f['size'] = size
             f['timestamp'] = int(time.time())
             f['dirty'] = False
-            self._msg_id_to_inode[msg.id] = inode
+            self._channels[f['chat_id']]['msg_to_inode'][msg.id] = inode
             log.debug(f"Delayed upload => inode={inode}, msg_id={msg.id}")
         except RPCError as e:
             log.error(
@@ -256,19 +602,52 @@ class TelegramFS(pyfuse3.Operations):
             )
             f['read_only'] = True
         finally:
-            # If cache is off and file is still closed, discard data
-            if inode in self._files:
-                if f['refcount'] == 0 and not self._cache_enabled:
-                    f['data'].clear()
+            if inode in self._files and not f['dirty']:
+                self._upload_done(inode, f)
 
             self._delayed_upload_tasks.pop(inode, None)
 
+    def _upload_done(self, inode: int, f: dict):
+        """Nothing left to upload => forget the journal entry, settle the buffer."""
+        self._journal.remove(f['journal'])
+        f['journal'] = None
+        # Still closed => move to cache or drop
+        self._buffers.settle(inode, f)
+
+    def _start_upload(self, inode: int, delay_s: int) -> asyncio.Task:
+        f = self._files[inode]
+        if f['file_id'] is None:
+            # New file => delayed upload, restart the delay if already queued
+            old_task = self._delayed_upload_tasks.pop(inode, None)
+            if old_task:
+                old_task.cancel()
+            t = asyncio.create_task(self._delayed_upload_new_file(inode, delay_s))
+            self._delayed_upload_tasks[inode] = t
+        else:
+            t = asyncio.create_task(self._upload_existing_file(inode))
+        self._track_upload(t)
+        return t
+
+    def _track_upload(self, task: asyncio.Task):
+        """Count queued uploads, so `write` can hold back when they pile up."""
+        self._pending_uploads += 1
+        if self._pending_uploads >= Config.upload_queue:
+            self._upload_room.clear()
+        task.add_done_callback(self._upload_finished)
+
+    def _upload_finished(self, task: asyncio.Task):
+        self._pending_uploads -= 1
+        if self._pending_uploads < Config.upload_queue:
+            self._upload_room.set()
+
     # FUSE ops
     async def getattr(self, inode, ctx=None) -> EntryAttributes:
         now_ns = int(time.time() * 1e9)
-        if inode == self._root_inode:
+        if inode in self._dirs:
+            chat_id = self._dir_chat.get(inode)
+            is_ro = self.read_only or (chat_id is not None and self._channels[chat_id]['read_only'])
             attr = EntryAttributes()
-            attr.st_mode = (stat.S_IFDIR | 0o755)
+            attr.st_mode = (stat.S_IFDIR | (0o555 if is_ro else 0o755))
             attr.st_ino = inode
             attr.st_uid = os.getuid()
             attr.st_gid = os.getgid()
@@ -287,7 +666,7 @@ class TelegramFS(pyfuse3.Operations):
 
         attr = EntryAttributes()
         attr.st_ino = inode
-        is_ro = self.read_only or f.get("read_only", False)
+        is_ro = self._is_read_only(f)
         attr.st_mode = stat.S_IFREG | (0o444 if is_ro else 0o644)
         attr.st_uid = os.getuid()
         attr.st_gid = os.getgid()
@@ -302,23 +681,25 @@ class TelegramFS(pyfuse3.Operations):
         return attr
 
     async def lookup(self, parent_inode, name, ctx=None) -> EntryAttributes:
-        if parent_inode != self._root_inode:
+        entries = self._dirs.get(parent_inode)
+        if entries is None:
             raise FUSEError(errno.ENOENT)
-        inode = self._name_to_inode.get(name)
+        inode = entries.get(name)
         if not inode:
             raise FUSEError(errno.ENOENT)
         return await self.getattr(inode)
 
     async def opendir(self, inode, ctx):
-        if inode != self._root_inode:
+        if inode not in self._dirs:
             raise FUSEError(errno.ENOTDIR)
         return inode
 
     async def readdir(self, fh, start_id, token):
-        if fh != self._root_inode:
+        entries = self._dirs.get(fh)
+        if entries is None:
             raise FUSEError(errno.ENOTDIR)
 
-        for fname, inode in sorted(self._name_to_inode.items(), key=lambda x: x[1]):
+        for fname, inode in sorted(entries.items(), key=lambda x: x[1]):
             if inode < start_id:
                 continue
             attr = await self.getattr(inode)
@@ -327,27 +708,33 @@ class TelegramFS(pyfuse3.Operations):
             if not ok:
                 break
 
+    def _pick_channel(self, parent_inode: int) -> int:
+        """Channel a new file in `parent_inode` is stored in."""
+        if parent_inode not in self._dir_chat:
+            # Top level of a multi-channel mount holds only channel directories
+            raise FUSEError(errno.EPERM)
+        chat_id = self._dir_chat[parent_inode]
+        if chat_id is not None:
+            if self._channels[chat_id]['read_only']:
+                raise FUSEError(errno.EROFS)
+            return chat_id
+
+        # Spread mode => writable channels in turn
+        writable = [c for c, ch in self._channels.items() if not ch['read_only']]
+        if not writable:
+            raise FUSEError(errno.EROFS)
+        chat_id = writable[self._next_spread % len(writable)]
+        self._next_spread += 1
+        return chat_id
+
     async def create(self, parent_inode, name, mode, flags, ctx):
         if self.read_only:
             raise FUSEError(errno.EROFS)
-        if parent_inode != self._root_inode:
-            raise FUSEError(errno.EPERM)
+        chat_id = self._pick_channel(parent_inode)
 
-        inode = self._next_inode
-        self._next_inode += 1
-        unique_name = self._unique_file_name(name)
-
-        self._files[inode] = {
-            'message_id': None,
-            'file_id': None,
-            'file_name': unique_name,
-            'size': 0,
-            'timestamp': int(time.time()),
-            'data': bytearray(),
-            'dirty': False,
-            'refcount': 1
-        }
-        self._name_to_inode[unique_name] = inode
+        inode = self._add_file(
+            chat_id, parent_inode, None, None, name, 0, int(time.time()), refcount=1
+        )
 
         fh = self._next_fh
         self._next_fh += 1
@@ -365,19 +752,27 @@ class TelegramFS(pyfuse3.Operations):
         accmode = flags & os.O_ACCMODE
         want_write = accmode in (os.O_WRONLY, os.O_RDWR)
 
-        if (self.read_only or f.get("read_only", False)) and want_write:
+        if self._is_read_only(f) and want_write:
             raise FUSEError(errno.EROFS)
 
-        if not (self.read_only or f.get("read_only", False)) and flags & os.O_TRUNC:
-            f["data"].clear()
+        if not self._is_read_only(f) and flags & os.O_TRUNC:
+            self._buffers.drop(inode, f)
+            self._heads.forget(inode)
             f["size"] = 0
             f["dirty"] = False
             f["file_id"] = None
             f["message_id"] = None
 
-        await self._download_if_needed(inode)
-
+        # Count as open before downloading, so the new buffer is not evicted
         f["refcount"] += 1
+        if want_write:
+            # Read-only opens download lazily in read()
+            try:
+                await self._download_if_needed(inode)
+            except BaseException:
+                f["refcount"] -= 1
+                raise
+
         fh = self._next_fh
         self._next_fh += 1
         self._fh_to_inode[fh] = inode
@@ -395,87 +790,109 @@ class TelegramFS(pyfuse3.Operations):
 
         if f['refcount'] == 0:
             # Always update size in case new writes came in
-            f['size'] = len(f['data'])
+            await self._buffers.ready(inode)
+            if f['refcount'] > 0 or inode not in self._files:
+                # Reopened or unlinked meanwhile
+                return
+            if f['dirty'] or self._buffers.is_loaded(f):
+                # Not loaded => only the head was read, the size stays
+                f['size'] = self._buffers.length(f)
 
             # 1) If not dirty at all, we can discard immediately (if cache is off).
             if not f['dirty']:
-                if not self._cache_enabled:
-                    f['data'].clear()
+                self._buffers.settle(inode, f)
                 return
 
             # 2) If read_only, we cannot upload => clear if cache is off.
-            if self.read_only:
+            if self._channels[f['chat_id']]['read_only']:
                 if not self._cache_enabled:
-                    f['data'].clear()
+                    self._buffers.drop(inode, f)
                 return
 
-            # 3) Not read-only + dirty => needs upload
-            if f['file_id'] is None:
-                # New file => schedule delayed upload
-                old_task = self._delayed_upload_tasks.pop(inode, None)
-                if old_task:
-                    old_task.cancel()
-
-                t = asyncio.create_task(self._delayed_upload_new_file(inode, 5))
-                self._delayed_upload_tasks[inode] = t
-            else:
+            # 3) Not read-only + dirty => needs upload, journal it first
+            await self._buffers.persist(inode, f)
+            entry_id = await offload.run(self._journal.record, f['chat_id'], f)
+            if inode not in self._files:
+                self._journal.remove(entry_id)
+                return
+            f['journal'] = entry_id
+            if f['refcount'] > 0:
+                # Reopened meanwhile => the next release uploads
+                return
+            is_new = f['file_id'] is None
+            t = self._start_upload(inode, delay_s=5)
+            if not is_new:
                 # Existing file => immediate re-upload
-                await self._upload_existing_file(inode)
+                await t
 
     async def read(self, fh, offset, size):
         inode = self._fh_to_inode.get(fh)
         if inode is None:
             raise FUSEError(errno.EBADF)
         f = self._files[inode]
-        return bytes(f['data'][offset:offset+size])
+        if not self._buffers.is_loaded(f) and f['file_id'] is not None:
+            if offset >= f['size']:
+                return b''
+            # Type sniffing reads only the start => serve it from the head
+            if offset + size <= DOWNLOAD_CHUNK or f['size'] <= DOWNLOAD_CHUNK:
+                head = await self._read_head(inode)
+                return head[offset:offset+size]
+        await self._download_if_needed(inode)
+        await self._buffers.ready(inode)
+        return await self._buffers.read(inode, f, offset, size)
 
     async def write(self, fh: int, offset: int, data: bytes) -> int:
+        if not self._upload_room.is_set():
+            log.debug(f"{self._pending_uploads} uploads pending => write waits.")
+            await self._upload_room.wait()
+
         inode = self._fh_to_inode.get(fh)
         if inode is None:
             raise FUSEError(errno.EBADF)
+        # Spills pending => let them reach the disk first
+        await self._buffers.drain()
+        await self._buffers.ready(inode)
 
         f = self._files[inode]
-        if self.read_only or f.get("read_only", False):
+        if self._is_read_only(f):
             raise FUSEError(errno.EROFS)
 
-        buf = f["data"]
-        end = offset + len(data)
-        if offset > len(buf):
-            buf.extend(b"\0" * (offset - len(buf)))
-        buf[offset:end] = data
         f["dirty"] = True
+        self._heads.forget(inode)
+        await self._buffers.write(inode, f, offset, data)
         return len(data)
 
     async def unlink(self, parent_inode: int, name: bytes, ctx):
         if self.read_only:
             raise FUSEError(errno.EROFS)
 
-        if parent_inode != self._root_inode:
+        entries = self._dirs.get(parent_inode)
+        if entries is None:
             raise FUSEError(errno.ENOTDIR)
 
-        inode = self._name_to_inode.get(name)
+        inode = entries.get(name)
         if inode is None:
             raise FUSEError(errno.ENOENT)
+        if inode in self._dirs:
+            raise FUSEError(errno.EISDIR)
 
         f = self._files[inode]
+        if self._channels[f['chat_id']]['read_only']:
+            raise FUSEError(errno.EROFS)
         if f.get("read_only", False):
             raise FUSEError(errno.EPERM)
 
         task = self._delayed_upload_tasks.pop(inode, None)
         if task:
             task.cancel()
+        self._journal.remove(f['journal'])
 
         old_mid = f["message_id"]
         if old_mid:
-            try:
-                await self._tg_client.delete_messages(self._chat_id, old_mid)
-            except RPCError:
-                f["read_only"] = True
-                raise FUSEError(errno.EPERM)
-            self._msg_id_to_inode.pop(old_mid, None)
+            # Removed locally now, the message goes with the next batch
+            self._channels[f['chat_id']]['deletes'].add(old_mid)
 
-        self._files.pop(inode, None)
-        self._name_to_inode.pop(name, None)
+        self._remove_file(inode)
 
     async def mkdir(self, *args, **kwargs):
         raise FUSEError(errno.ENOTDIR)
@@ -510,6 +927,30 @@ class TelegramFS(pyfuse3.Operations):
     async def forget(self, inode_list: Sequence[Tuple[pyfuse3.InodeT, int]]) -> None:
         return
 
+    def _xattrs(self, inode: int) -> dict:
+        if inode in self._dirs:
+            return {}
+        f = self._files.get(inode)
+        if not f:
+            raise FUSEError(errno.ENOENT)
+        attrs = {b'user.telegram.chat_id': str(f['chat_id']).encode('utf-8')}
+        if f['mime_type']:
+            attrs[b'user.mime_type'] = f['mime_type'].encode('utf-8')
+        if f['message_id']:
+            attrs[b'user.telegram.message_id'] = str(f['message_id']).encode('utf-8')
+        if f['file_id']:
+            attrs[b'user.telegram.file_id'] = f['file_id'].encode('utf-8')
+        return attrs
+
+    async def getxattr(self, inode, name, ctx):
+        value = self._xattrs(inode).get(name)
+        if value is None:
+            raise FUSEError(pyfuse3.ENOATTR)
+        return value
+
+    async def listxattr(self, inode, ctx):
+        return list(self._xattrs(inode))
+
     async def ioctl(self, fh, command, arg, fip, in_buf, out_buf_size) -> bytes:
         raise FUSEError(errno.ENOTTY)
 
@@ -0,0 +1,69 @@
+import os, json, uuid, contextlib
+
+from tgfuse.config import logging_config
+log = logging_config.setup_logging(__name__)
+
+
+class UploadJournal:
+    """
+    On-disk list of uploads that were queued but have not reached Telegram yet.
+    Each entry points at a spool file with the full content and says where it
+    goes, so a restarted tgfuse can finish the job:
+      {
+        'chat_id': int,
+        'name': str (file name, surrogateescape'd),
+        'message_id': int or None (old message to replace),
+        'spool': str
+      }
+    """
+    def __init__(self, base_dir: str):
+        self._dir = os.path.join(base_dir, 'journal')
+        os.makedirs(self._dir, exist_ok=True)
+
+    def _path(self, entry_id: str) -> str:
+        return os.path.join(self._dir, entry_id + '.json')
+
+    def record(self, chat_id: int, f: dict) -> str:
+        """Write (or overwrite) the entry for `f`, returns its id."""
+        entry_id = f.get('journal') or uuid.uuid4().hex
+        entry = {
+            'chat_id': chat_id,
+            'name': f['file_name'].decode('utf-8', 'surrogateescape'),
+            'message_id': f['message_id'],
+            'spool': f['spool'],
+        }
+        tmp = self._path(entry_id) + '.tmp'
+        with open(tmp, 'w') as out:
+            json.dump(entry, out)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, self._path(entry_id))
+        return entry_id
+
+    def remove(self, entry_id: str | None):
+        if not entry_id:
+            return
+        with contextlib.suppress(OSError):
+            os.unlink(self._path(entry_id))
+
+    def entries(self, chat_id: int) -> list:
+        """All pending entries for `chat_id` as (entry_id, entry) pairs."""
+        result = []
+        for fname in sorted(os.listdir(self._dir)):
+            if not fname.endswith('.json'):
+                continue
+            entry_id = fname[:-len('.json')]
+            try:
+                with open(self._path(entry_id)) as src:
+                    entry = json.load(src)
+            except (OSError, ValueError) as e:
+                log.warning(f"Skipping broken journal entry {fname}: {e}")
+                continue
+            if entry.get('chat_id') != chat_id:
+                continue
+            entry['name'] = entry['name'].encode('utf-8', 'surrogateescape')
+            result.append((entry_id, entry))
+        return result
+
+if __name__ == "__main__":
+    raise RuntimeError("This module should be run only via main.py")
@@ -0,0 +1,74 @@
+import asyncio, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from tgfuse.config.config import Config
+from tgfuse.config import logging_config
+log = logging_config.setup_logging(__name__)
+
+
+class Offload:
+    """
+    Worker threads for the blocking per-chunk work of transfers (spool and
+    cache file I/O, fsync, copying whole files into RAM), so it doesn't stall
+    the event loop that answers FUSE requests. At most `queue` jobs are
+    handed to the pool at once, further callers wait for a free slot.
+    Threads rather than processes: the work is I/O or GIL-releasing, and
+    shipping chunks to another process would cost more than it saves.
+    """
+    def __init__(self, workers: int, queue: int):
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="tgfuse-worker")
+        self._slots = asyncio.Semaphore(queue)
+
+    async def run(self, func, *args):
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag: how late a timer that should fire every
+    `interval` seconds actually runs. Every FUSE request waits for the loop,
+    so this is the delay blocking work adds to metadata operations.
+    """
+    def __init__(self, interval: float = 0.1, window: int = 3000):
+        self._interval = interval
+        # last `window` samples, ~5 minutes at the default interval
+        self._lags = deque(maxlen=window)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self._interval)
+            self._lags.append(time.perf_counter() - started - self._interval)
+
+    def report(self) -> str:
+        """p50/p99/max lag over the recent samples."""
+        lags = sorted(self._lags)
+        if not lags:
+            return "loop lag: no samples"
+        p50 = lags[len(lags) // 2]
+        p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))]
+        return (
+            f"loop lag: p50 {p50 * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms, "
+            f"max {lags[-1] * 1000:.1f}ms over {len(lags)} samples"
+        )
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+offload = Offload(Config.workers, Config.workers * 4)
+
+if __name__ == "__main__":
+    raise RuntimeError("This module should be run only via main.py")
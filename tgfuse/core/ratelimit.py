@@ -0,0 +1,138 @@
+import asyncio, heapq, itertools, time
+
+from pyrogram.errors import FloodWait
+
+from tgfuse.config.config import Config
+from tgfuse.config import logging_config
+log = logging_config.setup_logging(__name__)
+
+# Waiters with a lower value go first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# method class -> (requests per second, burst)
+DEFAULT_RATES = {
+    'info': (2.0, 5),      # get_me, get_chat, get_chat_member
+    'history': (3.0, 5),   # get_messages, search_messages pages
+    'send': (1.0, 3),      # send_message, send_document
+    'delete': (2.0, 3),    # delete_messages
+    # file chunks (1 MiB) of stream_media, all transfers together; no Telegram
+    # limit is known, this only bounds the start => FLOOD_WAITs find the real one
+    'file': (float(Config.file_rate), Config.file_rate),
+}
+
+
+class TokenBucket:
+    """
+    Token bucket for one class of Telegram methods.
+    On FLOOD_WAIT the bucket stops for the requested time and halves its
+    rate, every successful call then raises the rate a bit again, up to
+    the configured one.
+    """
+    def __init__(self, name: str, rate: float, burst: int):
+        self.name = name
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = rate / 16
+        self.burst = burst
+        self.tokens = float(burst)
+        self.blocked_until = 0.0
+        self._stamp = time.monotonic()
+        # heap of (priority, seq, future)
+        self._waiters = []
+        self._seq = itertools.count()
+        self._pump = None
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    async def acquire(self, priority: int):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run())
+        await fut
+
+    async def _run(self):
+        """Hand out tokens to the waiters, most urgent first."""
+        while self._waiters:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, fut = heapq.heappop(self._waiters)
+            # Caller gave up meanwhile
+            if fut.done():
+                continue
+            self.tokens -= 1
+            fut.set_result(None)
+
+    def flood_wait(self, seconds: int):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0.0
+        log.warning(
+            f"FLOOD_WAIT {seconds}s on '{self.name}' => pause, rate now {self.rate:.2f}/s."
+        )
+
+    def success(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 32)
+
+
+class RateLimiter:
+    """
+    Shared gate for all Telegram calls. Calls are queued per method class
+    instead of failing, FLOOD_WAIT errors are waited out and retried, and
+    interactive (FUSE) callers are served before background sync.
+    A `scope` (e.g. a chat id) gives the method class a separate bucket,
+    for limits Telegram applies per chat.
+    """
+    def __init__(self, rates: dict = DEFAULT_RATES):
+        self._rates = rates
+        # (kind, scope) -> TokenBucket
+        self._buckets = {}
+
+    def _bucket(self, kind: str, scope=None) -> TokenBucket:
+        bucket = self._buckets.get((kind, scope))
+        if bucket is None:
+            rate, burst = self._rates[kind]
+            name = kind if scope is None else f"{kind}:{scope}"
+            bucket = self._buckets[(kind, scope)] = TokenBucket(name, rate, burst)
+        return bucket
+
+    async def wait(self, kind: str, background: bool = False, scope=None):
+        """Take one token of `kind`, for calls that can't go through `call()`."""
+        await self._bucket(kind, scope).acquire(BACKGROUND if background else INTERACTIVE)
+
+    def flood_wait(self, kind: str, seconds: int, scope=None):
+        self._bucket(kind, scope).flood_wait(seconds)
+
+    def success(self, kind: str, scope=None):
+        self._bucket(kind, scope).success()
+
+    async def call(
+        self, kind: str, func, *args, background: bool = False, scope=None, **kwargs
+    ):
+        """Run `await func(*args, **kwargs)` under the `kind` bucket, retrying FLOOD_WAITs."""
+        bucket = self._bucket(kind, scope)
+        while True:
+            await bucket.acquire(BACKGROUND if background else INTERACTIVE)
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWait as e:
+                bucket.flood_wait(int(e.value))
+                continue
+            bucket.success()
+            return result
+
+
+limiter = RateLimiter()
+
+if __name__ == "__main__":
+    raise RuntimeError("This module should be run only via main.py")
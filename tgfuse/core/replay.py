@@ -0,0 +1,377 @@
+import os, time, signal, shutil, asyncio, argparse, tempfile, cProfile, pstats, datetime
+from io import BytesIO
+from types import SimpleNamespace
+from collections import Counter, defaultdict
+
+import pyfuse3
+from pyfuse3 import FUSEError
+
+from tgfuse.core.fuse import TelegramFS, DOWNLOAD_CHUNK
+from tgfuse.core.offload import LoopMonitor
+from tgfuse.core.trace import read_trace, OPS, TG_CALL, TG_STREAM, DOC, CHANNEL
+from tgfuse.funcs.index import save_index
+from tgfuse.config.config import Config
+from tgfuse.config import logging_config
+log = logging_config.setup_logging(__name__)
+
+_EPOCH = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+
+
+class FakeClient:
+    """
+    Stands in for the pyrogram client during replay. Serves the documents
+    seen in the trace with zero-filled content, keeps uploads and deletes,
+    and answers every method after its mean latency in the trace (per
+    result for search_messages and stream_media).
+    """
+    def __init__(self, docs: dict, latency: dict):
+        # chat_id -> {message_id: (file name, size, mime type)}
+        self._docs = docs
+        self._latency = latency
+        self._next_id = 1 + max(
+            (m_id for msgs in docs.values() for m_id in msgs), default=0
+        )
+        self.calls = Counter()
+
+    async def _wait(self, method: str):
+        self.calls[method] += 1
+        delay = self._latency.get(method)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def _message(self, chat_id: int, msg_id: int):
+        name, size, mime = self._docs[chat_id][msg_id]
+        doc = SimpleNamespace(
+            file_id=f"{chat_id}:{msg_id}", file_size=size, file_name=name, mime_type=mime
+        )
+        return SimpleNamespace(id=msg_id, empty=False, document=doc, date=_EPOCH)
+
+    async def get_me(self):
+        await self._wait('get_me')
+        return SimpleNamespace(is_bot=False)
+
+    async def search_messages(self, chat_id: int, offset: int = 0, filter=None):
+        for msg_id in sorted(self._docs.get(chat_id, {}), reverse=True)[offset:]:
+            await self._wait('search_messages')
+            if msg_id in self._docs.get(chat_id, {}):
+                yield self._message(chat_id, msg_id)
+
+    async def stream_media(self, file_id: str, limit: int = 0, offset: int = 0):
+        chat_id, msg_id = map(int, file_id.split(':'))
+        _, size, _ = self._docs.get(chat_id, {}).get(msg_id, (None, 0, None))
+        chunk = offset
+        while chunk * DOWNLOAD_CHUNK < size and not (limit and chunk - offset >= limit):
+            await self._wait('stream_media')
+            yield bytes(min(DOWNLOAD_CHUNK, size - chunk * DOWNLOAD_CHUNK))
+            chunk += 1
+
+    async def send_document(self, chat_id: int, document, file_name: str = None):
+        await self._wait('send_document')
+        if isinstance(document, BytesIO):
+            size = len(document.getbuffer())
+        else:
+            size = os.path.getsize(document)
+        msg_id = self._next_id
+        self._next_id += 1
+        self._docs.setdefault(chat_id, {})[msg_id] = (file_name, size, None)
+        return self._message(chat_id, msg_id)
+
+    async def delete_messages(self, chat_id: int, message_ids):
+        await self._wait('delete_messages')
+        ids = message_ids if isinstance(message_ids, list) else [message_ids]
+        for msg_id in ids:
+            self._docs.get(chat_id, {}).pop(msg_id, None)
+        return True
+
+
+class _ReaddirBuffer:
+    """The kernel's readdir buffer: one page of READDIRPLUS entries."""
+    def __init__(self, size: int = 4096):
+        self.room = size
+
+
+def _readdir_reply(token: _ReaddirBuffer, name: bytes, attr, next_id: int) -> bool:
+    # fuse_entry_out + fuse_dirent with the name, 8-byte aligned
+    need = 128 + ((24 + len(name) + 7) & ~7)
+    if need > token.room:
+        return False
+    token.room -= need
+    return True
+
+
+class Player:
+    """
+    Replays the FUSE ops of a trace against `fs`. Inodes and handles of the
+    trace are mapped to the ones `fs` hands out. An op starts once all ops
+    that had finished before it started in the trace are done here too, so
+    the recorded concurrency is kept without the idle time in between.
+    """
+    def __init__(self, fs: TelegramFS):
+        self._fs = fs
+        self._inodes = {pyfuse3.ROOT_INODE: pyfuse3.ROOT_INODE}
+        self._dirs = {}
+        self._fhs = {}
+        # op -> [replay duration]
+        self.times = defaultdict(list)
+        # op -> number of ops whose result differs from the trace
+        self.diverged = Counter()
+
+    def _inode(self, inode: int) -> int:
+        return self._inodes.get(inode, inode)
+
+    async def play(self, ops: list, realtime: bool = False, speed: float = 1.0):
+        tasks = [None] * len(ops)
+        by_end = sorted(range(len(ops)), key=lambda i: ops[i].t + ops[i].dur)
+        done = 0
+        started = time.perf_counter()
+        for i, rec in enumerate(ops):
+            while done < len(by_end) and ops[by_end[done]].t + ops[by_end[done]].dur <= rec.t:
+                task = tasks[by_end[done]]
+                done += 1
+                if task is not None:
+                    await asyncio.wait([task])
+            if realtime:
+                delay = rec.t / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks[i] = asyncio.create_task(self._run(rec))
+        pending = [t for t in tasks if t is not None]
+        if pending:
+            await asyncio.wait(pending)
+
+    async def _run(self, rec):
+        op = OPS[rec.kind - 1]
+        err = 0
+        start = time.perf_counter()
+        try:
+            await getattr(self, '_' + op)(rec)
+        except FUSEError as e:
+            err = e.errno
+        except KeyError:
+            # Handle of an open that failed here
+            err = -1
+        except Exception as e:
+            log.warning(f"Replaying {op} failed: {e!r}")
+            err = -1
+        self.times[op].append(time.perf_counter() - start)
+        if err != rec.err:
+            self.diverged[op] += 1
+
+    async def _lookup(self, rec):
+        attr = await self._fs.lookup(self._inode(rec.a), rec.name, None)
+        self._inodes[rec.c] = attr.st_ino
+
+    async def _getattr(self, rec):
+        await self._fs.getattr(self._inode(rec.a), None)
+
+    async def _opendir(self, rec):
+        self._dirs[rec.c] = await self._fs.opendir(self._inode(rec.a), None)
+
+    async def _readdir(self, rec):
+        fh = self._dirs.get(rec.a, self._inode(rec.a))
+        # Offsets are the next inode + 1
+        start_id = self._inode(rec.b - 1) + 1 if rec.b else 0
+        await self._fs.readdir(fh, start_id, _ReaddirBuffer())
+
+    async def _open(self, rec):
+        fi = await self._fs.open(self._inode(rec.a), rec.b, None)
+        self._fhs[rec.c] = fi.fh
+
+    async def _create(self, rec):
+        fi, attr = await self._fs.create(
+            self._inode(rec.a), rec.name, 0o644, os.O_CREAT | os.O_WRONLY, None
+        )
+        self._inodes[rec.b] = attr.st_ino
+        self._fhs[rec.c] = fi.fh
+
+    async def _read(self, rec):
+        await self._fs.read(self._fhs[rec.a], rec.b, rec.c)
+
+    async def _write(self, rec):
+        await self._fs.write(self._fhs[rec.a], rec.b, bytes(rec.c))
+
+    async def _release(self, rec):
+        await self._fs.release(self._fhs.pop(rec.a))
+
+    async def _flush(self, rec):
+        await self._fs.flush(self._fhs[rec.a])
+
+    async def _fsync(self, rec):
+        await self._fs.fsync(self._fhs[rec.a], False)
+
+    async def _unlink(self, rec):
+        await self._fs.unlink(self._inode(rec.a), rec.name, None)
+
+    async def _getxattr(self, rec):
+        await self._fs.getxattr(self._inode(rec.a), rec.name, None)
+
+    async def _listxattr(self, rec):
+        await self._fs.listxattr(self._inode(rec.a), None)
+
+    async def _statfs(self, rec):
+        await self._fs.statfs(None)
+
+
+class StackSampler:
+    """
+    Samples the Python stack of the main thread (event loop) on SIGPROF,
+    for flame graphs in folded format (flamegraph.pl, speedscope).
+    """
+    def __init__(self, interval: float = 0.001):
+        self._interval = interval
+        self.stacks = Counter()
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(names))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self._interval, self._interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def write(self, path: str):
+        with open(path, 'w') as out:
+            for stack, count in self.stacks.items():
+                out.write(f"{stack} {count}\n")
+
+
+def load(path: str) -> tuple:
+    """(chats, docs, FUSE ops by start time, Telegram latency per method) of a trace."""
+    chats = []
+    docs = defaultdict(dict)
+    sent = set()
+    ops = []
+    # method -> [total seconds, results or calls]
+    tg = defaultdict(lambda: [0.0, 0])
+    for rec in read_trace(path):
+        if rec.kind <= len(OPS):
+            ops.append(rec)
+        elif rec.kind == CHANNEL:
+            chats.append((rec.a, rec.name.decode('utf-8', 'replace'), bool(rec.b)))
+        elif rec.kind == DOC:
+            if rec.err:
+                # Uploaded during the session => created again by the replay
+                sent.add((rec.a, rec.b))
+            elif (rec.a, rec.b) not in sent:
+                name, _, mime = rec.name.decode('utf-8', 'replace').partition('\0')
+                docs[rec.a][rec.b] = (name, rec.c, mime or None)
+        elif rec.kind in (TG_CALL, TG_STREAM):
+            stats = tg[rec.name.decode('utf-8')]
+            stats[0] += rec.dur
+            stats[1] += rec.b if rec.kind == TG_STREAM else 1
+    ops.sort(key=lambda rec: rec.t)
+    latency = {method: secs / max(n, 1) for method, (secs, n) in tg.items()}
+    return chats, dict(docs), ops, latency
+
+
+def _ms(times: list) -> str:
+    if not times:
+        return "-"
+    times = sorted(times)
+    p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+    return f"{sum(times) / len(times) * 1000:8.2f} {p99 * 1000:8.2f}"
+
+
+def report(ops: list, player: Player, client: FakeClient, elapsed: float, lag: str):
+    recorded = defaultdict(list)
+    for rec in ops:
+        recorded[OPS[rec.kind - 1]].append(rec.dur)
+    span = max((rec.t + rec.dur for rec in ops), default=0) - min((rec.t for rec in ops), default=0)
+    print(f"Replayed {len(ops)} ops in {elapsed:.2f}s (trace: {span:.2f}s), event {lag}")
+    print(f"{'op':<10} {'count':>6} {'diverged':>8}   trace mean/p99 ms   replay mean/p99 ms")
+    for op in OPS:
+        if op not in recorded:
+            continue
+        print(
+            f"{op:<10} {len(recorded[op]):>6} {player.diverged[op]:>8}   "
+            f"{_ms(recorded[op]):>17}   {_ms(player.times[op]):>18}"
+        )
+    print("Telegram calls: " + ", ".join(f"{m} {n}" for m, n in client.calls.most_common()))
+
+
+async def _replay(chats: list, docs: dict, ops: list, latency: dict, args) -> tuple:
+    client = FakeClient(docs, latency)
+    fs = TelegramFS(client, chats, cache_enabled=Config.cache, spread=Config.spread)
+    await fs.init_fs()
+    monitor = LoopMonitor(interval=0.01)
+    monitor.start()
+    player = Player(fs)
+    started = time.perf_counter()
+    await player.play(ops, args.realtime, args.speed)
+    elapsed = time.perf_counter() - started
+    # Delayed uploads and batched deletes
+    await asyncio.sleep(args.settle)
+    await monitor.stop()
+    await fs.destroy()
+    return player, client, elapsed, monitor.report()
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(
+        prog='tgfuse replay',
+        description="Replay a trace recorded with TRACE=... against a fake Telegram client."
+    )
+    parser.add_argument('trace')
+    parser.add_argument('--profile', metavar='FILE', help="write cProfile stats (pstats, snakeviz)")
+    parser.add_argument('--folded', metavar='FILE', help="write sampled stacks for a flame graph")
+    parser.add_argument('--realtime', action='store_true', help="keep the recorded gaps between ops")
+    parser.add_argument('--speed', type=float, default=1.0, help="with --realtime, play N times faster")
+    parser.add_argument('--no-latency', action='store_true', help="answer Telegram calls at once")
+    parser.add_argument(
+        '--settle', type=float, default=6.0,
+        help="seconds to keep running after the last op, for background uploads (default: 6)"
+    )
+    args = parser.parse_args(argv)
+
+    chats, docs, ops, latency = load(args.trace)
+    if not chats:
+        parser.error(f"{args.trace} has no channels, was it cut short?")
+    if args.no_latency:
+        latency = {}
+    log.info(
+        f"Trace {args.trace}: {len(chats)} channel(s), "
+        f"{sum(map(len, docs.values()))} files, {len(ops)} ops."
+    )
+
+    # Fresh cache with the trace's files as the cached index => served at once
+    Config.cache_dir = tempfile.mkdtemp(prefix='tgfuse-replay-')
+    for chat_id, msgs in docs.items():
+        save_index(Config.cache_dir, chat_id, [
+            (m_id, f"{chat_id}:{m_id}", name.encode('utf-8'), size, 0, mime)
+            for m_id, (name, size, mime) in msgs.items()
+        ])
+    pyfuse3.readdir_reply = _readdir_reply
+
+    profiler = cProfile.Profile() if args.profile else None
+    sampler = StackSampler() if args.folded else None
+    try:
+        if sampler:
+            sampler.start()
+        if profiler:
+            profiler.enable()
+        player, client, elapsed, lag = asyncio.run(_replay(chats, docs, ops, latency, args))
+    finally:
+        if profiler:
+            profiler.disable()
+        if sampler:
+            sampler.stop()
+        shutil.rmtree(Config.cache_dir, ignore_errors=True)
+
+    report(ops, player, client, elapsed, lag)
+    if profiler:
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    if sampler:
+        sampler.write(args.folded)
+        print(f"Folded stacks written to {args.folded}")
+
+if __name__ == "__main__":
+    raise RuntimeError("This module should be run only via main.py")
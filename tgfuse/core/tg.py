@@ -1,20 +1,48 @@
-import sys, pyfuse3
+import sys, time, asyncio
+_import_start = time.perf_counter()
+
+import pyfuse3
 from pyrogram.client import Client
 
 from tgfuse.core.fuse import TelegramFS
 from tgfuse.core.fuse import fuse_runner
 
-from tgfuse.funcs.channel import test_write_permission, is_channel
+from tgfuse.funcs.channel import can_post, get_channel
 
 from tgfuse.config.config import Config
 from tgfuse.config import logging_config
 log = logging_config.setup_logging(__name__)
+_import_time = time.perf_counter() - _import_start
+
+
+async def check_channel(app: Client, chat_id: int) -> tuple:
+    """(chat_id, title, read_only) of a channel, exits if it isn't one."""
+    chat = await get_channel(app, chat_id)
+    if chat is None:
+        log.error(f"Chat {chat_id} is not a channel")
+        sys.exit(1)
+
+    # Check if we can write
+    read = not await can_post(app, chat_id)
+    log.info("Channel %s read-only mode: %s", chat_id, read)
+    return (chat_id, chat.title, read)
 
 
 async def init():
+    # Startup timing report => [(stage, seconds)]
+    timings = [("imports", _import_time)]
+    stamp = time.perf_counter()
+
+    def lap(stage: str):
+        nonlocal stamp
+        now = time.perf_counter()
+        timings.append((stage, now - stamp))
+        stamp = now
+
     api_id = Config.tg_id
     api_hash = Config.tg_hash
-    chat_id = Config.chat_id
+    # CHAT_IDS="id1,id2,..." mounts several channels, else just CHAT_ID
+    chat_ids = [int(c) for c in Config.chat_ids.split(',') if c.strip()] or [Config.chat_id]
     args = sys.argv[1:]
     if not api_id or not api_hash:
         log.error("Please set TG_API and TG_HASH environment variables.")
@@ -40,27 +68,45 @@ async def init():
         bot_token = None
         session_name = "tgfs_user_session"
 
+    # Default sleep_threshold: pyrogram sleeps through short FLOOD_WAITs and
+    # retries only the failed request; e.g. SendMedia after a finished upload,
+    # a raised one would make `limiter.call` upload the whole file again
     async with Client(session_name, api_id=api_id, api_hash=api_hash, bot_token=bot_token) as app:
-        # Check channel
-        if not await is_channel(app, chat_id):
-            log.error("This chat is not a channel")
-            sys.exit(1)
+        lap("connect")
+        chats = await asyncio.gather(*(check_channel(app, chat_id) for chat_id in chat_ids))
+        lap("channels")
 
-        # Check if we can write
-        can_write = await test_write_permission(app, chat_id)
-        read = not can_write
-        log.info("Read-only mode: %s", read)
+        client = app
+        recorder = None
+        if Config.trace:
+            from tgfuse.core.trace import TraceRecorder
+            recorder = TraceRecorder(Config.trace)
+            recorder.channels(chats)
+            client = recorder.client(app)
 
-        fs = TelegramFS(app, chat_id, read_only=read, cache_enabled=Config.cache)
+        fs = TelegramFS(client, list(chats), cache_enabled=Config.cache, spread=Config.spread)
+        if recorder:
+            recorder.attach(fs)
         await fs.init_fs()
+        lap("index")
 
         fuse_opts = set(pyfuse3.default_options)
         fuse_opts.add("default_permissions")
-        fuse_opts.add(f"fsname=TelegramFS(chat_id={chat_id})")
+        # libfuse splits -o values on commas => join the ids with '+'
+        fuse_opts.add(f"fsname=TelegramFS(chat_id={'+'.join(map(str, chat_ids))})")
         if Config.log_level == "DEBUG":
             fuse_opts.add("debug")
 
-        await fuse_runner(mount, fs, fuse_opts)
+        log.info(
+            "Startup timing: %s => mounting after %.2fs",
+            ", ".join(f"{stage} {secs:.2f}s" for stage, secs in timings),
+            sum(secs for _, secs in timings)
+        )
+        try:
+            await fuse_runner(mount, fs, fuse_opts)
+        finally:
+            if recorder:
+                recorder.close()
 
 async def start_bot():
     await init()
@@ -0,0 +1,240 @@
+import time, errno, struct, inspect, contextvars
+from collections import namedtuple
+
+from pyfuse3 import FUSEError
+
+from tgfuse.config import logging_config
+log = logging_config.setup_logging(__name__)
+
+MAGIC = b'TGFT'
+VERSION = 1
+# magic, version, wall clock time of the start
+_HEADER = struct.Struct('<4sBd')
+# kind, err, start (s since the trace start), duration (s), a, b, c, name length;
+# followed by the name
+_RECORD = struct.Struct('<BBdfqqqH')
+
+# FUSE ops, recorded with kind = index + 1. Fields per op:
+#   lookup     a=parent  c=inode            name
+#   getattr    a=inode
+#   opendir    a=inode   c=dir handle
+#   readdir    a=dir handle  b=start offset
+#   open       a=inode   b=flags  c=fh
+#   create     a=parent  b=inode  c=fh      name
+#   read/write a=fh      b=offset c=size
+#   release, flush, fsync  a=fh
+#   unlink     a=parent                     name
+#   getxattr   a=inode                      name
+#   listxattr  a=inode
+#   statfs
+OPS = (
+    'lookup', 'getattr', 'opendir', 'readdir', 'open', 'create', 'read', 'write',
+    'release', 'flush', 'fsync', 'unlink', 'getxattr', 'listxattr', 'statfs'
+)
+_FIELDS = {
+    'lookup': lambda args, r: (args[0], 0, r.st_ino if r else 0, args[1]),
+    'getattr': lambda args, r: (args[0], 0, 0, b''),
+    'opendir': lambda args, r: (args[0], 0, r or 0, b''),
+    'readdir': lambda args, r: (args[0], args[1], 0, b''),
+    'open': lambda args, r: (args[0], args[1], r.fh if r else 0, b''),
+    'create': lambda args, r: (args[0], r[1].st_ino if r else 0, r[0].fh if r else 0, args[1]),
+    'read': lambda args, r: (args[0], args[1], args[2], b''),
+    'write': lambda args, r: (args[0], args[1], len(args[2]), b''),
+    'release': lambda args, r: (args[0], 0, 0, b''),
+    'flush': lambda args, r: (args[0], 0, 0, b''),
+    'fsync': lambda args, r: (args[0], 0, 0, b''),
+    'unlink': lambda args, r: (args[0], 0, 0, args[1]),
+    'getxattr': lambda args, r: (args[0], 0, 0, args[1]),
+    'listxattr': lambda args, r: (args[0], 0, 0, b''),
+    'statfs': lambda args, r: (0, 0, 0, b''),
+}
+# Telegram call returning a coroutine: a=chat_id, b=results, c=bytes; name=method
+TG_CALL = 100
+# Telegram call returning an async generator (search_messages, stream_media): same fields,
+# duration = time spent waiting for items, without the time the consumer held each one
+TG_STREAM = 101
+# Document seen in a channel: a=chat_id, b=message_id, c=size,
+# name=file name + NUL + mime type, err=1 if this session uploaded it
+DOC = 102
+# Mounted channel: a=chat_id, b=read_only, name=title
+CHANNEL = 103
+
+Record = namedtuple('Record', 'kind err t dur a b c name')
+
+# Set while a FUSE op runs, so the ops it calls internally aren't recorded again
+_in_op = contextvars.ContextVar('tgfuse_trace_in_op', default=False)
+
+
+class TraceRecorder:
+    """
+    Writes the FUSE ops served by TelegramFS and the Telegram calls behind
+    them to a compact binary trace (40 bytes per record plus names), for
+    `tgfuse replay`. File names are recorded, content is not.
+    """
+    def __init__(self, path: str):
+        self._out = open(path, 'wb', buffering=64 * 1024)
+        self._start = time.perf_counter()
+        self._out.write(_HEADER.pack(MAGIC, VERSION, time.time()))
+        # (chat_id, message_id) already written as DOC
+        self._docs = set()
+        log.info(f"Recording FUSE ops and Telegram calls to {path}.")
+
+    def _write(self, kind: int, err: int, start: float, dur: float, a=0, b=0, c=0, name=b''):
+        if self._out.closed:
+            return
+        name = name[:0xffff]
+        self._out.write(
+            _RECORD.pack(kind, min(err, 255), start - self._start, dur, a, b, c, len(name)) + name
+        )
+
+    def channels(self, chats: list):
+        now = time.perf_counter()
+        for (chat_id, title, read_only) in chats:
+            self._write(CHANNEL, 0, now, 0, chat_id, int(read_only), 0, (title or '').encode('utf-8'))
+
+    def attach(self, fs):
+        """Record the FUSE ops of `fs`, by wrapping them on the instance."""
+        for op in OPS:
+            setattr(fs, op, self._traced(op, getattr(fs, op)))
+
+    def client(self, client):
+        """A proxy of `client` that records its calls."""
+        return TracedClient(client, self)
+
+    def _traced(self, op: str, method):
+        kind = OPS.index(op) + 1
+        fields = _FIELDS[op]
+
+        async def traced(*args):
+            if _in_op.get():
+                return await method(*args)
+            token = _in_op.set(True)
+            start = time.perf_counter()
+            err = 0
+            result = None
+            try:
+                result = await method(*args)
+                return result
+            except FUSEError as e:
+                err = e.errno
+                raise
+            except BaseException:
+                err = errno.EIO
+                raise
+            finally:
+                _in_op.reset(token)
+                self._write(kind, err, start, time.perf_counter() - start, *fields(args, result))
+        return traced
+
+    def _note_doc(self, chat_id: int, msg, sent: bool = False):
+        doc = getattr(msg, 'document', None)
+        if not doc or (chat_id, msg.id) in self._docs:
+            return
+        self._docs.add((chat_id, msg.id))
+        name = '\0'.join(
+            (getattr(doc, 'file_name', None) or '', getattr(doc, 'mime_type', None) or '')
+        )
+        self._write(
+            DOC, int(sent), time.perf_counter(), 0, chat_id, msg.id,
+            getattr(doc, 'file_size', None) or 0, name.encode('utf-8', 'replace')
+        )
+
+    async def _call(self, method: str, chat_id: int, coro):
+        start = time.perf_counter()
+        err = 0
+        result = None
+        try:
+            result = await coro
+            return result
+        except BaseException:
+            err = 1
+            raise
+        finally:
+            results = result if isinstance(result, list) else [result]
+            self._write(
+                TG_CALL, err, start, time.perf_counter() - start, chat_id,
+                sum(r is not None for r in results), 0, method.encode('utf-8')
+            )
+            for r in results:
+                self._note_doc(chat_id, r, sent=(method == 'send_document'))
+
+    async def _stream(self, method: str, chat_id: int, agen):
+        start = time.perf_counter()
+        # Only the time spent waiting for items: while suspended at `yield`
+        # the consumer is working, that isn't Telegram latency
+        waited = 0.0
+        err = 0
+        items = 0
+        size = 0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = await agen.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    waited += time.perf_counter() - started
+                items += 1
+                if isinstance(item, (bytes, bytearray, memoryview)):
+                    size += len(item)
+                else:
+                    self._note_doc(chat_id, item)
+                yield item
+        except GeneratorExit:
+            # The consumer stopped early, e.g. a read got all it needed
+            await agen.aclose()
+            raise
+        except BaseException:
+            err = 1
+            raise
+        finally:
+            self._write(
+                TG_STREAM, err, start, waited, chat_id, items, size, method.encode('utf-8')
+            )
+
+    def close(self):
+        if not self._out.closed:
+            self._out.close()
+
+
+class TracedClient:
+    """Stands in for the pyrogram client and records the duration of its calls."""
+    def __init__(self, client, recorder: TraceRecorder):
+        self._client = client
+        self._recorder = recorder
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            chat_id = args[0] if args and isinstance(args[0], int) else 0
+            if inspect.iscoroutine(result):
+                return self._recorder._call(name, chat_id, result)
+            if inspect.isasyncgen(result):
+                return self._recorder._stream(name, chat_id, result)
+            return result
+        return call
+
+
+def read_trace(path: str):
+    """Records of a trace as `Record`s; a torn last record is skipped."""
+    with open(path, 'rb') as src:
+        magic, version, _ = _HEADER.unpack(src.read(_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a tgfuse trace (version {VERSION})")
+        while True:
+            head = src.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                return
+            kind, err, t, dur, a, b, c, n = _RECORD.unpack(head)
+            name = src.read(n)
+            if len(name) < n:
+                return
+            yield Record(kind, err, t, dur, a, b, c, name)
+
+if __name__ == "__main__":
+    raise RuntimeError("This module should be run only via main.py")
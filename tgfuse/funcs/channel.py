@@ -1,42 +1,53 @@
 from tgfuse.funcs.docs import gather_docs_bot, gather_docs_userbot
-from pyrogram.enums import ChatType
+from pyrogram.enums import ChatType, ChatMemberStatus
 from pyrogram.client import Client
+from tgfuse.core.ratelimit import limiter
 
 from tgfuse.config import logging_config
 log = logging_config.setup_logging(__name__)
 
-async def test_write_permission(client: Client, chat_id: int) -> bool:
+async def can_post(client: Client, chat_id: int) -> bool:
+    """
+    Read our admin rights in `chat_id` instead of probing with a test message.
+    In a channel only the owner and admins with the post right can send.
+    """
     try:
-        msg = await client.send_message(chat_id, "Permission test, please ignore.")
-        await client.delete_messages(chat_id, msg.id)
-        return True
+        member = await limiter.call('info', client.get_chat_member, chat_id, "me")
     except Exception as e:
-        log.warning("No permission to send in chat (read-only mode). Error: %s", e)
+        log.warning("Can't read own rights in chat (read-only mode). Error: %s", e)
         return False
+    if member.status == ChatMemberStatus.OWNER:
+        return True
+    if member.status == ChatMemberStatus.ADMINISTRATOR and member.privileges:
+        return bool(member.privileges.can_post_messages)
+    log.warning("No permission to post in chat (read-only mode).")
+    return False
 
 
-async def gather_all_docs(client: Client, chat_id: int) -> list:
+async def gather_all_docs(client: Client, chat_id: int, background: bool = False) -> list:
     """
     Gather documents from all messages in `chat_id`.
     Works for both:
       - A 'userbot' session (phone-number login)
       - A normal 'bot' session (bot token)
+    `background` calls yield to interactive ones in the rate limiter.
     """
-    me = await client.get_me()
+    me = await limiter.call('info', client.get_me, background=background)
     if me.is_bot:
         # Use the chunk-based approach for normal bots.
-        return await gather_docs_bot(client, chat_id)
+        return await gather_docs_bot(client, chat_id, background)
     else:
         # Use Pyrogram's search for user accounts.
-        return await gather_docs_userbot(client, chat_id)
+        return await gather_docs_userbot(client, chat_id, background)
 
 
-async def is_channel(client: Client, chat_id: int) -> bool:
+async def get_channel(client: Client, chat_id: int):
+    """The chat object of `chat_id` if it is a channel, else None."""
     try:
-        chat = await client.get_chat(chat_id)
-        return chat.type == ChatType.CHANNEL
+        chat = await limiter.call('info', client.get_chat, chat_id)
     except Exception as e:
-        return False
+        return None
+    return chat if chat.type == ChatType.CHANNEL else None
 
 if __name__ == "__main__":
     raise RuntimeError("This module should be run only via main.py")
@@ -1,10 +1,11 @@
 from pyrogram.client import Client
-from pyrogram.errors import RPCError
+from pyrogram.errors import RPCError, FloodWait
 from pyrogram.enums import MessagesFilter
+from tgfuse.core.ratelimit import limiter
 from tgfuse.config import logging_config
 log = logging_config.setup_logging(__name__)
 
-async def gather_docs_bot(client: Client, chat_id: int) -> list:
+async def gather_docs_bot(client: Client, chat_id: int, background: bool = False) -> list:
     """
     For normal bots:
       - We can't use client.search_messages()
@@ -22,7 +23,9 @@ async def gather_docs_bot(client: Client, chat_id: int) -> list:
     while True:
         chunk_ids = list(range(current_id, current_id + chunk_size))
         try:
-            messages = await client.get_messages(chat_id, chunk_ids)
+            messages = await limiter.call(
+                'history', client.get_messages, chat_id, chunk_ids, background=background
+            )
         except RPCError as exc:
             log.warning(f"Error while fetching messages in BOT mode: {exc}")
             break
@@ -40,9 +43,10 @@ async def gather_docs_bot(client: Client, chat_id: int) -> list:
                 size = msg.document.file_size or 0
                 fname = msg.document.file_name or f"doc_{f_id[:10]}"
                 fname_b = fname.encode('utf-8', errors='replace')
+                mime = msg.document.mime_type
                 
                 t = int(msg.date.timestamp())
-                all_docs.append((m_id, f_id, fname_b, size, t))
+                all_docs.append((m_id, f_id, fname_b, size, t, mime))
                 found_any_docs = True
         
         if not found_any_docs:
@@ -58,24 +62,39 @@ async def gather_docs_bot(client: Client, chat_id: int) -> list:
     return all_docs
 
 
-async def gather_docs_userbot(client: Client, chat_id: int) -> list:
+async def gather_docs_userbot(client: Client, chat_id: int, background: bool = False) -> list:
     """
     For user accounts, we can simply call client.search_messages()
     with filter=DOCUMENT and iterate over all results.
+    search_messages() fetches pages of 100, we take a rate limiter token
+    per page and continue from the current offset after a FLOOD_WAIT.
     """
     all_docs = []
-    async for msg in client.search_messages(chat_id, filter=MessagesFilter.DOCUMENT):
-        if not msg.document:
-            continue
-        
-        m_id = msg.id
-        f_id = msg.document.file_id
-        size = msg.document.file_size or 0
-        fname = msg.document.file_name or f"doc_{f_id[:10]}"
-        fname_b = fname.encode('utf-8', errors='replace')
-        t = int(msg.date.timestamp())
-        
-        all_docs.append((m_id, f_id, fname_b, size, t))
+    page_size = 100
+    offset = 0
+    while True:
+        try:
+            await limiter.wait('history', background)
+            async for msg in client.search_messages(chat_id, offset=offset, filter=MessagesFilter.DOCUMENT):
+                offset += 1
+                if offset % page_size == 0:
+                    limiter.success('history')
+                    await limiter.wait('history', background)
+                if not msg.document:
+                    continue
+                
+                m_id = msg.id
+                f_id = msg.document.file_id
+                size = msg.document.file_size or 0
+                fname = msg.document.file_name or f"doc_{f_id[:10]}"
+                fname_b = fname.encode('utf-8', errors='replace')
+                mime = msg.document.mime_type
+                t = int(msg.date.timestamp())
+                
+                all_docs.append((m_id, f_id, fname_b, size, t, mime))
+            break
+        except FloodWait as e:
+            limiter.flood_wait('history', int(e.value))
     
     return all_docs
 
@@ -0,0 +1,44 @@
+import os, json
+
+from tgfuse.config import logging_config
+log = logging_config.setup_logging(__name__)
+
+
+def _index_path(base_dir: str, chat_id: int) -> str:
+    return os.path.join(base_dir, 'index', f"{chat_id}.json")
+
+
+def load_index(base_dir: str, chat_id: int) -> list | None:
+    """
+    Docs of `chat_id` as saved by the last sync, in the same
+    (m_id, f_id, fname_b, size, t, mime) form gather_all_docs() returns.
+    """
+    path = _index_path(base_dir, chat_id)
+    try:
+        with open(path) as src:
+            entries = json.load(src)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.warning(f"Ignoring broken index {path}: {e}")
+        return None
+    return [
+        (m_id, f_id, fname.encode('utf-8', 'surrogateescape'), size, t, mime)
+        for (m_id, f_id, fname, size, t, mime) in entries
+    ]
+
+
+def save_index(base_dir: str, chat_id: int, docs: list):
+    path = _index_path(base_dir, chat_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    entries = [
+        (m_id, f_id, fname_b.decode('utf-8', 'surrogateescape'), size, t, mime)
+        for (m_id, f_id, fname_b, size, t, mime) in docs
+    ]
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as out:
+        json.dump(entries, out)
+    os.replace(tmp, path)
+
+if __name__ == "__main__":
+    raise RuntimeError("This module should be run only via main.py")